@@ -0,0 +1,564 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks for typeform.py
+----------------------------------
+
+Generates a synthetic CfP (typeform v1 shaped responses plus the program
+draft / speakers / submissions / CfP csv exports) at 1k, 10k or 100k
+proposals, serves the responses from a local mock of the typeform api and
+times the pipeline stages against it. No typeform or google account needed.
+
+    ./benchmark.py generate --scale 10k
+    ./benchmark.py serve --scale 10k --port 8900
+    ./benchmark.py run --scale 10k
+    ./benchmark.py run --scale 10k --save-baseline
+
+Every stage runs in a fresh process; the heavy modules are imported there
+before the stage is timed. "stage MB" is how much the stage raised the
+peak RSS of that process, "peak MB" the process peak, set-up included.
+Results are compared with the baseline stored by --save-baseline (per
+scale) and the run fails if a stage got slower than --tolerance allows.
+
+Stages:
+
+    parse     _parse_response() over every response, no network
+    sync      full _sync_store() from the mock server into an empty store
+    frame     _load_frame() from the store
+    report    _build_report() of every dimension plus a crosstab
+    search    a batch of full-text _search() queries
+    mailing   _build_mailing() over the csv exports
+    schedule  _schedule_stats() over the csv exports
+
+The sandbox (store, config, caches) and the baseline live under the data
+directory, the real ~/.config/typeform is never touched.
+"""
+
+import calendar
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+
+import click  # http://click.pocoo.org/6/
+
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000}
+STAGES = ['parse', 'sync', 'frame', 'report', 'search', 'mailing',
+          'schedule']
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'devconf-benchmark')
+BASELINE_FILE = 'baseline.json'  # in the data directory
+SEED = 2018
+# what typeform.py imports lazily, paid for before a stage's timer starts
+# so a stage isn't timed with the import of them
+HEAVY_IMPORTS = ['numpy', 'pandas', 'requests', 'requests.adapters']
+
+
+def _typeform(home):
+    """Load typeform.py with its ~/.config/typeform inside home"""
+    import importlib.util
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'typeform.py')
+    spec = importlib.util.spec_from_file_location('typeform', path)
+    module = importlib.util.module_from_spec(spec)
+    # typeform.py resolves its paths at import time
+    real_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.environ['HOME'] = real_home
+    return module
+
+
+## Synthetic Data ##
+
+FIRST_NAMES = ['Jiří', 'Tomáš', 'Zuzana', 'Řehoř', 'Petr', 'Lukáš',
+               'Kateřina', 'Jan', 'Ondřej', 'Markéta', 'Chris', 'Anna',
+               'Priya', 'Václav', 'Šárka', 'Miloš']
+LAST_NAMES = ['Řehák', 'Novák', 'Dvořák', 'Černý', 'Procházka', 'Kučera',
+              'Veselý', 'Horák', 'Němec', 'Pokorný', 'Smith', 'Ward',
+              'Sharma', 'Žižka', 'Šťastný', 'Ďurica']
+THEMES = ['Cloud and Containers', 'Security', 'Debugging / Tracing',
+          'Storage', 'Networking', 'Developer Tools', 'Community',
+          'Agile', 'Kernel', 'Desktop', 'Testing', 'IoT', 'Big Data']
+TYPES = ['Talk 25m+5m', 'Talk 40m+10m', 'Workshop 100m+20m',
+         'Lightning 5m', 'Meetup', 'Discussion 40m+10m']
+DIFFICULTIES = ['Beginner', 'Intermediate', 'Advanced']
+COUNTRIES = ['Czech Republic', 'Slovakia', 'Germany', 'USA', 'India',
+             'Poland', 'UK', 'Israel', 'Brazil']
+ORGS = ['Red Hat', 'Brno University of Technology', 'Masaryk University',
+        'Fedora Project', 'CentOS', 'IBM', 'Google', 'Independent',
+        'SUSE', 'Canonical']
+SIZES = ['S', 'M', 'L', 'XL', 'XXL', 'Fitted S', 'Fitted M']
+WORDS = ['openshift', 'kubernetes', 'container', 'kernel', 'ansible',
+         'fedora', 'systemd', 'python', 'golang', 'rust', 'tracing', 'ebpf',
+         'security', 'selinux', 'storage', 'ceph', 'gluster', 'network',
+         'operator', 'cloud', 'openstack', 'testing', 'automation', 'ci',
+         'community', 'desktop', 'gnome', 'wayland', 'podman', 'buildah',
+         'performance', 'debugging', 'microservices', 'serverless',
+         'machine', 'learning', 'data', 'pipeline', 'řešení', 'vývoj',
+         'bezpečnost', 'úložiště', 'síť', 'nástroje', 'komunita']
+SEARCH_QUERIES = ['openshift', 'kernel tracing', 'container*', '"machine '
+                  'learning"', 'Rehak', 'ceph storage', 'bezpecnost',
+                  'python automation', 'ebpf', 'Dvorak', 'cloud operator',
+                  'wayland']
+
+
+def _sentence(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _twitter(rng, handle):
+    # the same messy mix the form gets
+    return rng.choice(['@' + handle, handle, '',
+                       'https://twitter.com/' + handle,
+                       'twitter.com/@' + handle, handle[:1]])
+
+
+def _speakers(rng, count):
+    speakers = []
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        handle = '{}{}{}'.format(first, last, i).lower()
+        handle = handle.encode('ascii', 'ignore').decode('ascii')
+        speakers.append({
+            'name': '{} {}'.format(first, last),
+            'email': '{}@example.com'.format(handle),
+            'country': rng.choice(COUNTRIES),
+            'org': rng.choice(ORGS),
+            'size': rng.choice(SIZES),
+            'twitter': _twitter(rng, handle),
+            'avatar': 'https://example.com/avatars/{}.png'.format(handle),
+            'bio': _sentence(rng, 20, 60),
+        })
+    return speakers
+
+
+def _form(tf, rng, count, speakers):
+    """A typeform v1 response document with count responses"""
+    questions = []
+    ids = {}
+    for i, question in enumerate(tf.QUESTION_ALIAS):
+        alias = tf.QUESTION_ALIAS[question]
+        if alias == 'theme':
+            # every theme checkbox is its own "question"
+            for j, theme in enumerate(THEMES):
+                qid = 'list_{}_choice_{}'.format(i, j)
+                questions.append({'id': qid, 'question': question})
+                ids[theme] = qid
+        else:
+            qid = 'textfield_{}'.format(i)
+            questions.append({'id': qid, 'question': question})
+            ids[alias] = qid
+
+    start = datetime.datetime(2017, 9, 1)
+    seconds = 90 * 24 * 3600
+    stamps = sorted(rng.randrange(seconds) for _ in range(count))
+
+    responses = []
+    for n, stamp in enumerate(stamps):
+        speaker = rng.choice(speakers)
+        answers = {
+            ids['agreement']: '1',
+            ids['title']: _sentence(rng, 3, 9).capitalize(),
+            ids['type']: rng.choice(TYPES),
+            ids['difficulty']: rng.choice(DIFFICULTIES),
+            ids['abstract']: _sentence(rng, 60, 160),
+        }
+        for theme in rng.sample(THEMES, rng.randint(1, 3)):
+            answers[ids[theme]] = theme
+        for alias in ['name', 'country', 'bio', 'org', 'size', 'email',
+                      'avatar', 'twitter']:
+            answers[ids[alias]] = speaker[alias]
+        if rng.random() < 0.2:
+            other = rng.choice(speakers)
+            answers[ids['secondary']] = '{} <{}>'.format(other['name'],
+                                                         other['email'])
+        submitted = start + datetime.timedelta(seconds=stamp)
+        responses.append({
+            'completed': '1',
+            'token': '{:032x}'.format(rng.getrandbits(128)),
+            'metadata': {
+                'network_id': '{:010x}'.format(rng.getrandbits(40) + n),
+                'date_submit': submitted.strftime('%Y-%m-%d %H:%M:%S'),
+            },
+            'answers': answers,
+        })
+    return {'http_status': 200, 'stats': {'responses': {'total': count}},
+            'questions': questions, 'responses': responses}
+
+
+def _write_csv(path, rows, columns):
+    import csv
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _csv_exports(tf, rng, out_dir, form, speakers):
+    """The sheet exports email / schedule / cleanup work from"""
+    questions = dict((x['id'], x['question']) for x in form['questions'])
+
+    submissions = []
+    for i, response in enumerate(form['responses']):
+        row = {'id': i + 1}
+        for qid, value in response['answers'].items():
+            row[tf.QUESTION_ALIAS[questions[qid]]] = value
+        submissions.append(row)
+
+    # ~40% make it into the program, some with a second speaker
+    program = []
+    for row in rng.sample(submissions, len(submissions) * 2 // 5):
+        emails = [row['email']]
+        if rng.random() < 0.15:
+            emails.append(rng.choice(speakers)['email'])
+        duration = row['type'].split(' ')[-1].split('+')
+        program.append({
+            'session_id': row['id'],
+            'title': row['title'],
+            'type': row['type'].split(' ')[0],
+            'track': rng.choice(THEMES),
+            'speakers': '; '.join(emails),
+            'session_duration': 'duration:{}'.format(
+                duration[0].rstrip('m') if duration[0][:1].isdigit()
+                else 40),
+            'session_qa': 'qa:{}'.format(
+                duration[1].rstrip('m') if len(duration) > 1 else 0),
+        })
+    program.sort(key=lambda x: x['session_id'])
+
+    # the speakers sheet has the odd duplicate row
+    rows = list(speakers) + rng.sample(speakers, len(speakers) // 20)
+    _write_csv(os.path.join(out_dir, 'speakers.csv'), rows,
+               ['email', 'name', 'country', 'org', 'size', 'twitter',
+                'avatar', 'bio'])
+    _write_csv(os.path.join(out_dir, 'submissions.csv'), submissions,
+               ['id', 'title', 'name', 'email', 'org', 'type', 'difficulty',
+                'abstract'])
+    _write_csv(os.path.join(out_dir, 'cfp.csv'), submissions,
+               ['id', 'email', 'title'])
+    _write_csv(os.path.join(out_dir, 'program.csv'), program,
+               ['session_id', 'title', 'type', 'track', 'speakers',
+                'session_duration', 'session_qa'])
+
+
+def _generate(data_dir, scale, seed=SEED):
+    """Write scale/responses.json and the csv exports, return the dir"""
+    out_dir = os.path.join(data_dir, scale)
+    if os.path.exists(os.path.join(out_dir, 'responses.json')):
+        return out_dir
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    tf = _typeform(os.path.join(data_dir, 'home-' + scale))
+    count = SCALES[scale]
+    rng = random.Random(seed)
+    speakers = _speakers(rng, max(10, count * 3 // 5))
+    form = _form(tf, rng, count, speakers)
+    _csv_exports(tf, rng, out_dir, form, speakers)
+
+    path = os.path.join(out_dir, 'responses.json')
+    with open(path + '.part', 'w') as f:
+        json.dump(form, f, ensure_ascii=False)
+    os.rename(path + '.part', path)
+    return out_dir
+
+
+## Mock Typeform ##
+
+def _mock_server(form, host='127.0.0.1', port=0):
+    """typeform v1 `GET /v1/form/<id>` with offset, limit and since"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import urllib.parse
+
+    responses = form['responses']
+    # date_submit is UTC, like the watermark typeform.py sends as since
+    epochs = [calendar.timegm(time.strptime(x['metadata']['date_submit'],
+                                            '%Y-%m-%d %H:%M:%S'))
+              for x in responses]
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            import bisect
+
+            query = dict(urllib.parse.parse_qsl(
+                urllib.parse.urlparse(self.path).query))
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', len(responses)))
+            # responses are sorted by submission, since is a timestamp
+            first = bisect.bisect_right(epochs, int(query.get('since', -1)))
+            page = responses[first + offset:first + offset + limit]
+            stats = {'responses': dict(form['stats']['responses'],
+                                       showing=len(responses) - first)}
+            body = json.dumps(dict(form, responses=page, stats=stats),
+                              ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+## Stages ##
+#
+# Each stage gets the loaded typeform module and the scale directory, does
+# its (untimed) set-up and returns the timed callable, which returns how
+# many items it processed.
+
+def _synced_store(tf, url):
+    conn = tf._open_store()
+    if not tf._count_proposals(conn):
+        tf._sync_store(conn, {'bench': (url, {})}, full=True)
+    return conn
+
+
+def _stage_parse(tf, scale_dir, url):
+    form = json.load(open(os.path.join(scale_dir, 'responses.json')))
+    questions = dict((x['id'], x['question']) for x in form['questions'])
+
+    def run():
+        for response in form['responses']:
+            tf._parse_response(response, questions)
+        return len(form['responses'])
+    return run
+
+
+def _stage_sync(tf, scale_dir, url):
+    if os.path.exists(tf.STORE_FILE):
+        os.remove(tf.STORE_FILE)
+    conn = tf._open_store()
+
+    def run():
+        return tf._sync_store(conn, {'bench': (url, {})}, full=True)
+    return run
+
+
+def _stage_frame(tf, scale_dir, url):
+    conn = _synced_store(tf, url)
+
+    def run():
+        return len(tf._load_frame(conn))
+    return run
+
+
+def _stage_report(tf, scale_dir, url):
+    proposals = tf._load_frame(_synced_store(tf, url))
+
+    def run():
+        tf._build_report(proposals, tf.REPORT_DIMS,
+                         [('theme', 'difficulty'), ('country', 'type')])
+        return len(proposals)
+    return run
+
+
+def _stage_search(tf, scale_dir, url):
+    conn = _synced_store(tf, url)
+    queries = SEARCH_QUERIES * 10
+
+    def run():
+        for query in queries:
+            tf._search(conn, query, limit=20)
+        return len(queries)
+    return run
+
+
+def _load_exports(tf, scale_dir):
+    def path(name):
+        return os.path.join(scale_dir, name + '.csv')
+
+    speakers = tf._load_table(path('speakers'))
+    submissions = tf._load_table(path('submissions'))
+    sched = tf._load_table(path('program'))
+    cfp = tf._load_table(path('cfp'), ['id', 'email', 'title'])
+    sched['speakers'] = sched.speakers.map(
+        lambda x: [y.strip() for y in x.split(';')])
+    return speakers, submissions, sched, cfp
+
+
+def _stage_mailing(tf, scale_dir, url):
+    speakers, submissions, sched, cfp = _load_exports(tf, scale_dir)
+
+    def run():
+        tf._build_mailing(speakers, submissions, sched, cfp)
+        return len(cfp)
+    return run
+
+
+def _stage_schedule(tf, scale_dir, url):
+    speakers, submissions, sched, cfp = _load_exports(tf, scale_dir)
+
+    def run():
+        tf._schedule_stats(sched, speakers)
+        return len(sched)
+    return run
+
+
+def _run_stage(stage, data_dir, scale, url):
+    """Child process: set up, time the stage, report its memory
+
+    ru_maxrss is the high-water mark of the whole process, set-up and
+    imports included; stage_mb is how far the stage itself raised it.
+    """
+    import importlib
+    import resource
+
+    for module in HEAVY_IMPORTS:
+        importlib.import_module(module)
+    tf = _typeform(os.path.join(data_dir, 'home-' + scale))
+    if not os.path.exists(tf.BASE_PATH):
+        os.makedirs(tf.BASE_PATH)
+    run = globals()['_stage_' + stage](tf, os.path.join(data_dir, scale), url)
+
+    # kilobytes on linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    start = time.perf_counter()
+    items = run()
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {'items': items, 'seconds': seconds,
+            'per_second': items / seconds if seconds else 0,
+            'stage_mb': peak - before, 'process_peak_mb': peak}
+
+
+def _measure(stage, data_dir, scale, url):
+    import multiprocessing
+
+    # spawn, so each stage starts from a clean interpreter
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(_run_stage, (stage, data_dir, scale, url))
+
+
+## CLI ##
+
+@click.group()
+@click.option('--data', default=DATA_DIR, help='Where the data sets live')
+@click.pass_context
+def cli(ctx, data):
+    """Synthetic CfP data, a mock typeform api and the benchmarks"""
+    ctx.obj = {'data': os.path.expanduser(data)}
+
+
+@cli.command()
+@click.option('--scale', default='10k', type=click.Choice(sorted(SCALES)))
+@click.option('--seed', default=SEED, help='Same seed, same data set')
+@click.pass_obj
+def generate(obj, scale, seed):
+    """Write the synthetic responses and csv exports"""
+    start = time.time()
+    out_dir = _generate(obj['data'], scale, seed=seed)
+    print('{} proposals in {} ({:.1f}s)'.format(SCALES[scale], out_dir,
+                                                time.time() - start))
+
+
+@cli.command()
+@click.option('--scale', default='10k', type=click.Choice(sorted(SCALES)))
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8900)
+@click.pass_obj
+def serve(obj, scale, host, port):
+    """Serve the synthetic responses as the typeform v1 api"""
+    out_dir = _generate(obj['data'], scale)
+    form = json.load(open(os.path.join(out_dir, 'responses.json')))
+    server = _mock_server(form, host, port)
+    print('Serving {} responses on http://{}:{}/v1/form/BENCH'.format(
+        len(form['responses']), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@cli.command()
+@click.option('--scale', default='10k', type=click.Choice(sorted(SCALES)))
+@click.option('--stages', default=','.join(STAGES),
+              help='Comma separated, default: all of them')
+@click.option('--baseline', default=None,
+              help='Baseline file (default: baseline.json in --data)')
+@click.option('--save-baseline', default=False, is_flag=True,
+              help='Store this run as the baseline for the scale')
+@click.option('--tolerance', default=0.2,
+              help='Allowed throughput drop vs the baseline (0.2 = 20%)')
+@click.option('--json-out', default=None, help='Also write results here')
+@click.pass_obj
+def run(obj, scale, stages, baseline, save_baseline, tolerance, json_out):
+    """Time every stage, compare with the baseline"""
+    import threading
+
+    stages = [x.strip() for x in stages.split(',') if x.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            raise click.BadParameter('unknown stage {}'.format(stage),
+                                     param_hint='--stages')
+
+    out_dir = _generate(obj['data'], scale)
+    form = json.load(open(os.path.join(out_dir, 'responses.json')))
+    server = _mock_server(form)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/v1/form/BENCH'.format(server.server_port)
+    del form
+
+    baseline = os.path.expanduser(
+        baseline or os.path.join(obj['data'], BASELINE_FILE))
+    try:
+        baselines = json.load(open(baseline))
+    except Exception:
+        baselines = {}
+    previous = baselines.get(scale, {})
+
+    results = {}
+    regressions = []
+    print('{:<10} {:>8} {:>9} {:>12} {:>9} {:>9} {:>9}'.format(
+        'stage', 'items', 'seconds', 'items/s', 'stage MB', 'peak MB',
+        'vs base'))
+    try:
+        for stage in stages:
+            result = _measure(stage, obj['data'], scale, url)
+            results[stage] = result
+            change = ''
+            if stage in previous and previous[stage]['per_second']:
+                ratio = result['per_second'] / previous[stage]['per_second']
+                change = '{:+.0%}'.format(ratio - 1)
+                if ratio < 1 - tolerance:
+                    regressions.append(stage)
+                    change += ' !'
+            print('{:<10} {:>8} {:>9.3f} {:>12.0f} {:>9.1f} {:>9.1f} {:>9}'
+                  .format(stage, result['items'], result['seconds'],
+                          result['per_second'], result['stage_mb'],
+                          result['process_peak_mb'], change))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if json_out:
+        with open(json_out, 'w') as f:
+            json.dump({'scale': scale, 'stages': results}, f, indent=2)
+
+    if save_baseline:
+        baselines[scale] = dict(previous, **results)
+        with open(baseline + '.part', 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        os.rename(baseline + '.part', baseline)
+        print('Saved as the {} baseline in {}'.format(scale, baseline))
+    elif regressions:
+        raise click.ClickException('slower than the baseline: {}'.format(
+            ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    cli()
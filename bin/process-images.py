@@ -2,54 +2,323 @@
 # -*- coding: utf-8 -*-
 
 # This script is used to normalize avatar photos
-# It's based off a .sh script created by 
+# It's based off a .sh script created by
 #   Jaroslav Kortus <jkortus@redhat.com>
+#
+# Usage: ./process-images.py ROOT_DIR SIZE [SIZE ...]
+#
+#   ./process-images.py ~/devconf 100 300 600
+#
+# Every avatar in ROOT_DIR/avatars-unprocessed is decoded once and all the
+# requested SIZExSIZE variants are written from that single decode into
+# avatars-processed-output/SIZExSIZE. Files are spread over all the cores.
+#
+# The output matches what we used to get from
+#
+#   convert SRC -resize NxN -gravity South -background transparent \
+#       -extent NxN -density 1x1 OUT.jpg
+#
+# A manifest of what every output was built from (source content hash, size
+# and processing parameters) is kept in avatars-processed-output, so reruns
+# only process new or changed avatars and new sizes. Outputs whose source
+# avatar is gone are removed.
+#
+# Images that can't be processed are copied to ROOT_DIR/avatars-processed-bad
+# and listed, with the reason, in avatars-processed-bad/report.json
+#
+# `typeform.py avatars --sizes ...` loads this file and uses decode(), render()
+# and save() to resize avatars straight from the download, and
+# `typeform.py site-images` uses decode(), scale() and encode() through
+# convert_responsive() to build the srcset variants of the site images.
+#
+# Needs Pillow (pip install pillow)
 
+import hashlib
+import json
 import os
+import shutil
 import sys
-import subprocess
 
-root_dir = sys.argv[1]
-src_dir = os.path.join(root_dir, 'avatars-unprocessed')
-out_root = os.path.join('avatars-processed-output')
-bad_dir = os.path.join(root_dir, 'avatars-processed-bad')
+# -background transparent; jpeg has no alpha so this ends up black, same
+# as it did with imagemagick
+BACKGROUND = (0, 0, 0, 0)
+DENSITY = (1, 1)
+JPEG_QUALITY = 92  # imagemagick's default
 
-if not os.path.exists(bad_dir):
-    os.mkdir(bad_dir)
+# everything that affects the output besides the source and the size; bump
+# this when changing render() so existing outputs get rebuilt
+PARAMS = {
+    'gravity': 'South',
+    'background': BACKGROUND,
+    'density': DENSITY,
+    'quality': JPEG_QUALITY,
+    'version': 1,
+}
+MANIFEST = '.manifest.json'
 
-if not os.path.exists(out_root):
-    os.mkdir(out_root)
+# site images (scale / encode), same rule as PARAMS
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+RESPONSIVE_PARAMS = {
+    'quality': JPEG_QUALITY,
+    'webp': WEBP_QUALITY,
+    'avif': AVIF_QUALITY,
+    'version': 1,
+}
 
-def convert(size_x):
-    size_y = size_x
 
-    dir_name = '{}x{}'.format(size_x, size_y)
-    out_dir = os.path.join(out_root, dir_name)
+def render(image, size_x, size_y=None):
+    """-resize NxN -gravity South -background transparent -extent NxN"""
+    from PIL import Image
 
-    if not os.path.exists(out_dir):
-        os.mkdir(out_dir)
+    size_y = size_y or size_x
+    # -resize fits the image inside the box, keeping the aspect ratio
+    scale = min(float(size_x) / image.width, float(size_y) / image.height)
+    width = max(1, int(round(image.width * scale)))
+    height = max(1, int(round(image.height * scale)))
+    resized = image.resize((width, height), Image.LANCZOS)
 
-    files = os.listdir(src_dir)
-    print('Processing {} files'.format(len(files)))
+    # -gravity South -extent: centered horizontally, stuck to the bottom
+    canvas = Image.new('RGBA', (size_x, size_y), BACKGROUND)
+    canvas.paste(resized, ((size_x - width) // 2, size_y - height))
+    return canvas
 
-    cmd = 'convert {} -resize {}x{} -gravity South -background transparent -extent {}x{} -density 1x1 "{}"  || cp {} {}'
 
-    for _file in files:
-        if os.path.isdir(_file):
+def save(image, path):
+    """Write the variant as jpeg, atomically"""
+    tmp_path = path + '.part'
+    image.convert('RGB').save(tmp_path, 'JPEG', quality=JPEG_QUALITY,
+                              dpi=DENSITY)
+    os.rename(tmp_path, path)
+
+
+def decode(source):
+    """Load the image once, normalized to RGBA"""
+    from PIL import Image
+
+    image = Image.open(source)
+    image.load()
+    return image.convert('RGBA')
+
+
+def scale(image, width):
+    """-resize Wx, keeps the aspect ratio and never upscales"""
+    from PIL import Image
+
+    if width >= image.width:
+        return image
+    height = max(1, int(round(image.height * float(width) / image.width)))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def encode(image, path, fmt):
+    """Write image as fmt (jpeg, png, webp or avif), atomically"""
+    tmp_path = path + '.part'
+    if fmt == 'jpeg':
+        image.convert('RGB').save(tmp_path, 'JPEG', quality=JPEG_QUALITY,
+                                  optimize=True, progressive=True)
+    elif fmt == 'png':
+        image.save(tmp_path, 'PNG', optimize=True)
+    elif fmt == 'webp':
+        image.save(tmp_path, 'WEBP', quality=WEBP_QUALITY, method=6)
+    elif fmt == 'avif':
+        image.save(tmp_path, 'AVIF', quality=AVIF_QUALITY)
+    else:
+        raise ValueError('unknown format {}'.format(fmt))
+    os.rename(tmp_path, path)
+
+
+def convert_responsive(source, variants):
+    """Decode source once and encode every (width, fmt, path) variant
+
+    Same contract as convert_file(). Pillow drops the GIL while resizing
+    and encoding, so this is fine to run in a thread pool.
+    """
+    try:
+        image = decode(source)
+        if image.getextrema()[3] == (255, 255):
+            # fully opaque, don't pay for an alpha plane in webp / avif
+            image = image.convert('RGB')
+        outputs = []
+        for width, fmt, out_path in variants:
+            encode(scale(image, width), out_path, fmt)
+            outputs.append(out_path)
+        return source, outputs, None
+    except Exception as e:
+        return source, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def variant_path(out_root, source, size):
+    dir_name = '{}x{}'.format(size, size)
+    file_base = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(out_root, dir_name, file_base + dir_name + '.jpg')
+
+
+def convert_file(source, sizes, out_root):
+    """Decode source once and write one variant per size
+
+    Returns a (source, outputs, error) tuple, never raises, so it can be
+    used as is in a process pool.
+    """
+    try:
+        image = decode(source)
+        outputs = []
+        for size in sizes:
+            out_path = variant_path(out_root, source, size)
+            save(render(image, size), out_path)
+            outputs.append(out_path)
+        return source, outputs, None
+    except Exception as e:
+        return source, [], '{}: {}'.format(type(e).__name__, e)
+
+
+def convert_all(jobs, out_root, workers=None):
+    """Convert every {source: [sizes]} job across a process pool
+
+    Returns the outputs written per source and the list of failures as
+    {'file': ..., 'sizes': ..., 'error': ...} dicts.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    for size in set(x for sizes in jobs.values() for x in sizes):
+        out_dir = os.path.join(out_root, '{}x{}'.format(size, size))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+    done = {}
+    failures = []
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_file, source, sizes, out_root)
+                   for source, sizes in jobs.items()]
+        for future in futures:
+            source, outputs, error = future.result()
+            if error:
+                failures.append({'file': source, 'sizes': jobs[source],
+                                 'error': error})
+            else:
+                done[source] = outputs
+    return done, failures
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_manifest(out_root):
+    try:
+        return json.load(open(os.path.join(out_root, MANIFEST)))
+    except Exception:
+        return {}
+
+
+def save_manifest(out_root, manifest):
+    path = os.path.join(out_root, MANIFEST)
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(path + '.part', path)
+
+
+def manifest_entry(source, digest, size):
+    # json turns the tuples in PARAMS into lists, so compare like with like
+    params = json.loads(json.dumps(PARAMS))
+    return {'source': os.path.basename(source), 'sha256': digest,
+            'size': size, 'params': params}
+
+
+def plan(sources, sizes, out_root, manifest):
+    """Work out which sources need which sizes (re)built
+
+    Returns the {source: [sizes]} jobs and the expected manifest entry of
+    every output, keyed on its path relative to out_root.
+    """
+    jobs = {}
+    expected = {}
+    for source in sources:
+        digest = file_hash(source)
+        for size in sizes:
+            out_path = variant_path(out_root, source, size)
+            key = os.path.relpath(out_path, out_root)
+            entry = manifest_entry(source, digest, size)
+            expected[key] = entry
+            if manifest.get(key) != entry or not os.path.exists(out_path):
+                jobs.setdefault(source, []).append(size)
+    return jobs, expected
+
+
+def prune(sources, out_root, manifest):
+    """Remove outputs (and their manifest entries) of vanished sources"""
+    names = set(os.path.basename(x) for x in sources)
+    removed = []
+    for key, entry in list(manifest.items()):
+        if entry['source'] in names:
             continue
+        out_path = os.path.join(out_root, key)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        del manifest[key]
+        removed.append(out_path)
+    return removed
+
+
+def report_failures(failures, bad_dir):
+    """Copy the sources that failed to bad_dir along with a report.json"""
+    if not os.path.exists(bad_dir):
+        os.mkdir(bad_dir)
+
+    for failure in failures:
+        shutil.copy(failure['file'], bad_dir)
+        print('FAILED: {file} ({error})'.format(**failure))
+
+    with open(os.path.join(bad_dir, 'report.json'), 'w') as f:
+        json.dump(failures, f, indent=2)
+
+
+def list_sources(src_dir):
+    sources = []
+    for _file in sorted(os.listdir(src_dir)):
         _file = os.path.join(src_dir, _file)
-        file_base = os.path.basename(_file)[:-4]
-        out_ext = '{}.jpg'.format(dir_name)
-        out_file = file_base + out_ext
-        out_path = os.path.join(out_dir, out_file)
-        bad_path = os.path.join(bad_dir, out_file)
-        _run = cmd.format(_file, size_x, size_y, 
-                          size_x, size_y, out_path, 
-                          _file, bad_path)
-        os.system(_run)
+        if os.path.isdir(_file):
+            continue
+        sources.append(_file)
+    return sources
+
+
+def main(argv):
+    root_dir = argv[1]
+    sizes = [int(arg) for arg in argv[2:]]
+    if not sizes:
+        return
+    src_dir = os.path.join(root_dir, 'avatars-unprocessed')
+    out_root = os.path.join('avatars-processed-output')
+    bad_dir = os.path.join(root_dir, 'avatars-processed-bad')
+
+    sources = list_sources(src_dir)
+    manifest = load_manifest(out_root)
+
+    for out_path in prune(sources, out_root, manifest):
+        print('Removed {}'.format(out_path))
+
+    jobs, expected = plan(sources, sizes, out_root, manifest)
+    print('Processing {} of {} files into {}'.format(
+        len(jobs), len(sources), ', '.join('{0}x{0}'.format(x)
+                                           for x in sizes)))
+
+    done, failures = convert_all(jobs, out_root)
+    for source, outputs in done.items():
+        for out_path in outputs:
+            key = os.path.relpath(out_path, out_root)
+            manifest[key] = expected[key]
+    save_manifest(out_root, manifest)
 
+    report_failures(failures, bad_dir)
+    print('Done, {} of {} files failed'.format(len(failures), len(jobs)))
 
-if len(sys.argv) >= 2:
-    for arg in sys.argv[2:]:
-        convert(arg)
 
+if __name__ == '__main__':
+    if len(sys.argv) >= 2:
+        main(sys.argv)
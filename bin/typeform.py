@@ -21,45 +21,91 @@ Example Config
         }
     }
 
+Or, for more than one event, one form per event name:
+
+    {
+        "forms": {
+            "devconf-cz": {"url": "...", "params": {...}},
+            "devconf-us": {"url": "...", "params": {...}},
+            "devconf-in": {"url": "...", "params": {...}}
+        }
+    }
+
 Usage
 -----
     ./typeform.py count [sessions]
     ./typeform.py count speakers
+    ./typeform.py count --by-event
+    ./typeform.py --event devconf-us report theme
+    ./typeform.py --profile --metrics-out metrics.json save
+
+Responses are cached in ~/.config/typeform/proposals.db and only responses
+newer than the last one seen are fetched on each run. To rebuild the cache
+from scratch:
 
+    ./typeform.py --full-sync count
 
 EOT
 
 """
 
-from collections import defaultdict, Counter
+import calendar
+from collections import defaultdict
+import contextlib
 import datetime
+import functools
 import json
-import numpy as np
 import os
 import re
-import requests
 import shutil
-import subprocess
+import sqlite3
 import time
 
 import click  # http://click.pocoo.org/6/
-from df2gspread import df2gspread as d2g
-import pandas as pd
+
+# NOTE: pandas, numpy, requests, df2gspread and the google api client are
+# slow to import, so they are imported inside the functions that need them.
+# `--help`, `count` and friends shouldn't pay for the whole stack.
 
 
 ## LOAD CONFIG FILE ##
 
 BASE_PATH = os.path.expanduser("~/.config/typeform/")
 CONFIG_FILE = os.path.join(BASE_PATH, "config.json")
-config = json.load(open(CONFIG_FILE))
-url = config['url']
-params = config['params']
-
 LABEL_MAP_FILE = os.path.join(BASE_PATH, 'label_map.json')
-try:
-    LABEL_MAP = json.load(open(LABEL_MAP_FILE))
-except Exception:
-    LABEL_MAP = {}
+
+
+@functools.lru_cache()
+def _get_config():
+    return json.load(open(CONFIG_FILE))
+
+
+# the event of a config with a single url / params pair
+DEFAULT_EVENT = 'devconf-cz'
+
+
+def _get_forms():
+    """{event: (url, params)} of every form in the config"""
+    config = _get_config()
+    forms = config.get('forms') or {DEFAULT_EVENT: config}
+    return dict((event, (form['url'], form.get('params', {})))
+                for event, form in forms.items())
+
+
+def _form_event(form_id):
+    """The event a typeform form id (the end of its url) belongs to"""
+    for event, (url, params) in _get_forms().items():
+        if url.rstrip('/').split('/')[-1] == form_id:
+            return event
+    return DEFAULT_EVENT
+
+
+@functools.lru_cache()
+def _get_label_map():
+    try:
+        return json.load(open(LABEL_MAP_FILE))
+    except Exception:
+        return {}
 
 ## Set-Up some CONSTANTS
 QUESTION_ALIAS = {
@@ -88,11 +134,18 @@ SESSION_FIELDS = ['submitted', 'title', 'type', 'theme', 'difficulty',
 
 ALL_FIELDS = SPEAKER_FIELDS + SESSION_FIELDS
 
+# low-cardinality fields, held as pandas categoricals
+CATEGORY_FIELDS = ['type', 'theme', 'difficulty', 'country', 'org', 'size',
+                   'event']
+
+# big free text, loaded apart and only for the commands reading it
+TEXT_FIELDS = ['abstract', 'bio']
+
 
 ## Shared Functions
 
 def _normalize_value(key, value):
-    return LABEL_MAP.get(key, {}).get(value, value)
+    return _get_label_map().get(key, {}).get(value, value)
 
 
 def _clean_twitter(handle):
@@ -104,56 +157,591 @@ def _clean_twitter(handle):
     return handle
 
 
-def _get_data(url, params):
-    ## Set-up Working Variables ##
-    r = requests.get(url, params=params)
-    results = r.json()
+def _parse_response(response, questions):
+    # These are the actual form responses
+    answers = response['answers']
+    # Grab the date the form was submitted
+    dt_str = response['metadata']['date_submit']
+    dt = datetime.datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S')
+    network_id = response['metadata'].get('network_id')
+    if network_id:
+        _id = (network_id + '+' + dt_str).replace(' ', '')
+    else:
+        # webhooks carry no network_id, see _reconcile_ids
+        _id = response['token']
+
+    # Save the submission date
+    proposal = {'_id': _id, 'submitted': dt}
+    if response.get('token'):
+        # the one thing polled and webhook responses have in common
+        proposal['token'] = response['token']
+    # Gonna aggregate multiple themes into a single list
+    proposal['theme'] = []
+
+    for field, value in answers.items():
+        value = value.strip()
+        # Grab the actual (though unreadable) form label id
+        _field = questions[field]
+        # Swap it with the simplified field alias for dict keys
+        alias = QUESTION_ALIAS[_field]
+
+        if alias == 'theme':
+            proposal[alias].append(value)
+        elif alias == 'twitter':
+            value = _clean_twitter(value)
+            proposal[alias] = value
+        else:
+            # raw value, LABEL_MAP is applied when building the DataFrame
+            proposal[alias] = value
+
+    proposal['theme'] = '; '.join(sorted(proposal['theme']))
+    return proposal
+
+
+## Metrics ##
+#
+# Timed spans (per phase, aggregated by name) and counters for a run. They
+# cost nothing unless --profile / --metrics-out turned them on; spans and
+# counters may be recorded from any thread.
+
+class _Metrics(object):
+
+    def __init__(self):
+        import threading
+
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.spans = {}  # name: [count, total seconds, max seconds]
+        self.counters = defaultdict(int)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator, every call is a span"""
+        def _decorator(func):
+            @functools.wraps(func)
+            def _wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return _wrapper
+        return _decorator
+
+    def record(self, name, elapsed):
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += elapsed
+            span[2] = max(span[2], elapsed)
+
+    def incr(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += value
+
+    def as_dict(self):
+        spans = dict((k, {'count': v[0], 'seconds': round(v[1], 6),
+                          'max_seconds': round(v[2], 6)})
+                     for k, v in self.spans.items())
+        return {'spans': spans, 'counters': dict(self.counters)}
+
+    def as_prometheus(self, prefix='devconf'):
+        lines = []
+        for metric, i, kind in [('span_seconds_total', 1, 'counter'),
+                                ('span_count_total', 0, 'counter'),
+                                ('span_seconds_max', 2, 'gauge')]:
+            lines.append('# TYPE {}_{} {}'.format(prefix, metric, kind))
+            for name, span in sorted(self.spans.items()):
+                lines.append('{}_{}{{span="{}"}} {}'.format(
+                    prefix, metric, name, span[i]))
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        lines = ['{:<28} {:>6} {:>10} {:>10}'.format(
+            'span', 'count', 'seconds', 'max')]
+        for name, span in sorted(self.spans.items(),
+                                 key=lambda x: x[1][1], reverse=True):
+            lines.append('{:<28} {:>6} {:>10.3f} {:>10.3f}'.format(
+                name, *span))
+        for name, value in sorted(self.counters.items()):
+            lines.append('{:<28} {:>6}'.format(name, value))
+        return '\n'.join(lines)
+
+
+METRICS = _Metrics()
+
+
+def _count_retries(response):
+    """Count the retries urllib3 did behind a requests response"""
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        METRICS.incr('retries', len(retries.history))
+
+
+## Typeform Client ##
+#
+# The v1 form api pages with offset / limit. Pages are fetched in waves of
+# `concurrency` concurrent requests (asyncio, over the pooled session that
+# already retries 429/5xx with backoff) and parsed proposals are handed to
+# the caller page by page, so we never hold the whole response set.
+
+PAGE_SIZE = 500
+CONCURRENCY = 4
+
+
+def _iter_proposals(url, params, page_size=PAGE_SIZE,
+                    concurrency=CONCURRENCY, timeout=60, retries=5):
+    """Yield the parsed proposals of every response, page by page"""
+    import asyncio
+
+    session = _get_session(workers=concurrency, per_host=concurrency,
+                           retries=retries)
+    loop = asyncio.new_event_loop()
+
+    def _get(_params):
+        with METRICS.span('typeform.fetch'):
+            r = session.get(url, params=_params, timeout=timeout)
+        METRICS.incr('typeform_api_calls')
+        METRICS.incr('bytes_fetched', len(r.content))
+        _count_retries(r)
+        r.raise_for_status()
+        with METRICS.span('typeform.decode'):
+            return r.json()
+
+    async def _fetch(offset):
+        _params = dict(params, offset=offset, limit=page_size)
+        return await loop.run_in_executor(None, _get, _params)
+
+    async def _wave(offsets):
+        return await asyncio.gather(*[_fetch(x) for x in offsets])
+
+    def _parse(page):
+        # parse out the question labels
+        questions = dict((x['id'], x['question']) for x in page['questions'])
+        with METRICS.span('typeform.parse'):
+            parsed = [_parse_response(x, questions)
+                      for x in page['responses']]
+        METRICS.incr('responses_parsed', len(parsed))
+        return parsed
 
-    # parse out the question labels
-    questions = dict((x['id'], x['question']) for x in results['questions'])
-    # parse out all the responses
-    responses = results['responses']
+    try:
+        # the first page alone: most syncs are a handful of new responses
+        first = _get(dict(params, offset=0, limit=page_size))
+        for proposal in _parse(first):
+            yield proposal
+        # a short page means we ran out of responses
+        if len(first['responses']) < page_size:
+            return
+
+        # `showing` is how many match the filters, when typeform says
+        showing = first.get('stats', {}).get('responses', {}).get('showing')
+        left = None
+        if showing is not None:
+            left = -(-(int(showing) - page_size) // page_size)
+        offset = page_size
+        while left is None or left > 0:
+            wave = concurrency if left is None else min(concurrency, left)
+            offsets = [offset + i * page_size for i in range(wave)]
+            pages = loop.run_until_complete(_wave(offsets))
+            for page in pages:
+                for proposal in _parse(page):
+                    yield proposal
+            if any(len(x['responses']) < page_size for x in pages):
+                break
+            offset = offsets[-1] + page_size
+            if left is not None:
+                left -= wave
+    finally:
+        loop.close()
+        session.close()
+
+
+## Local Proposal Store ##
+#
+# Every response we ever parsed is kept in a small sqlite db next to the
+# config, keyed on the same `_id` we build from network_id + date_submit
+# (the response token for webhook deliveries, see _reconcile_ids).
+# On each run we only ask typeform for responses submitted after the newest
+# one we already have (the `since` watermark) and merge them in.
+
+STORE_FILE = os.path.join(BASE_PATH, 'proposals.db')
+DT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# fields in the full-text index behind `search`; diacritics are folded so
+# "Rehak" finds "Řehák"
+SEARCH_FIELDS = ['title', 'abstract', 'bio', 'org', 'theme', 'name']
+
+
+def _open_store(path=None):
+    conn = sqlite3.connect(path or STORE_FILE)
+    conn.execute('CREATE TABLE IF NOT EXISTS proposals ('
+                 '_id TEXT PRIMARY KEY, submitted TEXT NOT NULL, '
+                 'data TEXT NOT NULL, event TEXT NOT NULL DEFAULT {!r})'.format(
+                     DEFAULT_EVENT))
+    columns = [x[1] for x in conn.execute('PRAGMA table_info(proposals)')]
+    if 'event' not in columns:
+        # a store from before events, all of it came from the one form
+        with conn:
+            conn.execute('ALTER TABLE proposals ADD COLUMN event TEXT NOT '
+                         'NULL DEFAULT {!r}'.format(DEFAULT_EVENT))
+    conn.execute("CREATE INDEX IF NOT EXISTS proposals_token ON proposals "
+                 "(json_extract(data, '$.token'))")
+    conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                 'key TEXT PRIMARY KEY, value TEXT)')
+    # the `_id`s already appended to each google sheet (path/worksheet),
+    # with the hash and values of the row as last written
+    conn.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                 'sheet TEXT NOT NULL, _id TEXT NOT NULL, '
+                 'hash TEXT, data TEXT, '
+                 'PRIMARY KEY (sheet, _id))')
+    columns = [x[1] for x in conn.execute('PRAGMA table_info(uploads)')]
+    if 'hash' not in columns:
+        with conn:
+            conn.execute('ALTER TABLE uploads ADD COLUMN hash TEXT')
+            conn.execute('ALTER TABLE uploads ADD COLUMN data TEXT')
+
+    if _get_meta(conn, 'search_key') != 'rowid':
+        # the index shares the rowid of proposals, so a proposal's row in
+        # it is looked up rather than scanned for; an index from before
+        # that (keyed on an UNINDEXED _id) is rebuilt
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS search')
+            conn.execute("CREATE VIRTUAL TABLE search USING fts5({}, "
+                         "tokenize='unicode61 remove_diacritics 2')".format(
+                             ', '.join(SEARCH_FIELDS)))
+            _index_proposals(conn, _load_proposals(conn))
+            _set_meta(conn, 'search_key', 'rowid')
+    return conn
+
+
+def _get_meta(conn, key, default=None):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                       (key,)).fetchone()
+    return row[0] if row else default
+
+
+def _set_meta(conn, key, value):
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                 (key, str(value)))
+
+
+def _watermark_key(event):
+    # DEFAULT_EVENT keeps the key of the single form stores
+    if event == DEFAULT_EVENT:
+        return 'watermark'
+    return 'watermark:' + event
+
+
+def _bump_version(conn):
+    # anything cached off the dataset (ie, reports) is now stale
+    _set_meta(conn, 'version', int(_get_meta(conn, 'version', 0)) + 1)
+
+
+@METRICS.timed('store.reconcile')
+def _reconcile_ids(conn, proposals):
+    """Give proposals already stored under another `_id` that one
+
+    Polled responses are keyed on network_id + date_submit, which webhook
+    payloads don't have, so those are keyed on the response token. Both
+    carry the token, so whichever way a response arrives second it's
+    matched on it and stored over the first copy instead of next to it.
+    Webhook rows stored before the token was kept are keyed token +
+    date_submit, they're matched too.
+    """
+    aliases = {}
+    for proposal in proposals:
+        token = proposal.get('token')
+        if token:
+            aliases[token] = token
+            aliases[token + '+' + proposal['submitted'].strftime(
+                DT_FORMAT).replace(' ', '')] = token
+    known = {}
+    keys = list(aliases)
+    for i in range(0, len(keys), 400):
+        chunk = keys[i:i + 400]
+        marks = ', '.join('?' * len(chunk))
+        rows = conn.execute(
+            "SELECT json_extract(data, '$.token'), _id FROM proposals "
+            "WHERE json_extract(data, '$.token') IN ({0}) "
+            "OR _id IN ({0})".format(marks), chunk + chunk)
+        for token, _id in rows:
+            known[token or aliases[_id]] = _id
+    reconciled = []
+    for proposal in proposals:
+        _id = known.get(proposal.get('token'))
+        if _id and _id != proposal['_id']:
+            proposal = dict(proposal, _id=_id)
+        reconciled.append(proposal)
+    return reconciled
+
+
+@METRICS.timed('store.write')
+def _store_proposals(conn, proposals):
+    """Upsert proposals, returns how many were new or changed"""
+    proposals = _reconcile_ids(conn, proposals)
+    rows = []
+    for proposal in proposals:
+        data = dict(proposal, submitted=proposal['submitted'].strftime(
+            DT_FORMAT))
+        rows.append((data['_id'], data['submitted'], json.dumps(data),
+                     data.get('event', DEFAULT_EVENT)))
+    # an upsert rather than INSERT OR REPLACE, that keeps the rowid the
+    # search index is keyed on; a response fetched again as it was (ie,
+    # typeform's since is inclusive) isn't a change
+    before = conn.total_changes
+    conn.executemany('INSERT INTO proposals (_id, submitted, data, event) '
+                     'VALUES (?, ?, ?, ?) ON CONFLICT (_id) DO UPDATE SET '
+                     'submitted = excluded.submitted, data = excluded.data, '
+                     'event = excluded.event WHERE proposals.data IS NOT '
+                     'excluded.data OR proposals.event IS NOT excluded.event',
+                     rows)
+    changed = conn.total_changes - before
+    _index_proposals(conn, proposals)
+    return changed
+
+
+def _index_proposals(conn, proposals):
+    """Add (or replace) stored proposals in the full-text index"""
+    rowids = {}
+    ids = list(set(x['_id'] for x in proposals))
+    for i in range(0, len(ids), 400):
+        chunk = ids[i:i + 400]
+        rowids.update((_id, rowid) for rowid, _id in conn.execute(
+            'SELECT rowid, _id FROM proposals WHERE _id IN ({})'.format(
+                ', '.join('?' * len(chunk))), chunk))
+    # one row per proposal, the last copy wins if a batch has it twice
+    rows = {}
+    for x in proposals:
+        rowid = rowids[x['_id']]
+        rows[rowid] = [rowid] + [x.get(f) or '' for f in SEARCH_FIELDS]
+    conn.executemany('DELETE FROM search WHERE rowid = ?',
+                     [(rowid,) for rowid in rows])
+    conn.executemany('INSERT INTO search (rowid, {}) VALUES (?{})'.format(
+        ', '.join(SEARCH_FIELDS), ', ?' * len(SEARCH_FIELDS)),
+        list(rows.values()))
+
+
+def _match_query(query, column=None):
+    """Turn what the user typed into a safe fts5 MATCH expression
+
+    Words are ANDed, "quoted words" are phrases and a trailing * makes a
+    prefix query, everything else is taken literally.
+    """
+    terms = []
+    for term in re.findall(r'"[^"]*"|\S+', query):
+        prefix = term.endswith('*')
+        term = term.strip('"*').replace('"', '""')
+        if not term:
+            continue
+        terms.append('"{}"{}'.format(term, '*' if prefix else ''))
+    match = ' '.join(terms)
+    if column and terms:
+        match = '{} : ({})'.format(column, match)
+    return match
+
+
+@METRICS.timed('store.search')
+def _search(conn, query, column=None, since=None, limit=20, events=None):
+    """Ranked (bm25) search, returns [(score, proposal), ...]"""
+    match = _match_query(query, column)
+    if not match:
+        return []
+    where, args = _filter_clause(since, events)
+    where = where.replace('WHERE', 'AND')
+    rows = conn.execute(
+        'SELECT bm25(search), proposals.event, proposals.data FROM search '
+        'JOIN proposals ON proposals.rowid = search.rowid '
+        'WHERE search MATCH ?' + where + ' '
+        'ORDER BY bm25(search) LIMIT ?', (match,) + args + (limit,))
+    # bm25() is "more negative is better", flip it for display
+    return [(-score, dict(json.loads(data), event=event))
+            for score, event, data in rows]
+
+
+def _filter_clause(since=None, events=None):
+    clauses = []
+    args = ()
+    if since:
+        clauses.append('submitted >= ?')
+        # since is a UNIX timestamp, as passed to typeform, submitted is UTC
+        since = datetime.datetime.utcfromtimestamp(since)
+        args += (since.strftime(DT_FORMAT),)
+    if events:
+        clauses.append('event IN ({})'.format(', '.join('?' * len(events))))
+        args += tuple(events)
+    if not clauses:
+        return '', ()
+    return ' WHERE ' + ' AND '.join(clauses), args
+
+
+def _load_proposals(conn, since=None):
+    where, args = _filter_clause(since)
+    query = 'SELECT data FROM proposals' + where + ' ORDER BY submitted'
 
-    # Prepare buckets for speakers and sessions separately
     proposals = []
+    for (data,) in conn.execute(query, args):
+        proposal = json.loads(data)
+        proposal['submitted'] = datetime.datetime.strptime(
+            proposal['submitted'], DT_FORMAT)
+        proposals.append(proposal)
+    return proposals
 
-    for response in responses:
-        # These are the actual form responses
-        answers = response['answers']
-        # Grab the date the form was submitted
-        dt_str = response['metadata']['date_submit']
-        dt = datetime.datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S')
-        _id = (
-            response['metadata']['network_id'] + '+' + dt_str).replace(' ', '')
-
-        # Save the submission date
-        proposal = {'_id': _id, 'submitted': dt}
-        # Gonna aggregate multiple themes into a single list
-        proposal['theme'] = []
-
-        for field, value in answers.items():
-            value = value.strip()
-            # Grab the actual (though unreadable) form label id
-            _field = questions[field]
-            # Swap it with the simplified field alias for dict keys
-            alias = QUESTION_ALIAS[_field]
-
-            if alias == 'theme':
-                proposal[alias].append(value)
-            elif alias == 'twitter':
-                value = _clean_twitter(value)
-                proposal[alias] = value
-            else:
-                proposal[alias] = _normalize_value(alias, value)
-
-        else:
-            proposal['theme'] = '; '.join(sorted(proposal['theme']))
-            proposals.append(proposal)
 
-    # Reverse Sort by date submitted
-    proposals = pd.DataFrame(proposals).fillna("UNKNOWN")
-    # reorder the colomns
-    proposals = proposals[SESSION_FIELDS + SPEAKER_FIELDS]
+@METRICS.timed('store.sync')
+def _sync_store(conn, forms, full=False):
+    """Fetch only the responses newer than each form's watermark
+
+    forms is {event: (url, params)}. Every form is fetched and parsed by
+    its own worker thread while the proposals are written here, by the one
+    sqlite connection, as the pages come in.
+    """
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    pages = queue.Queue()
+    stop = threading.Event()
+
+    def _fetch(event, url, params):
+        try:
+            batch = []
+            for proposal in _iter_proposals(url, params):
+                if stop.is_set():
+                    return
+                proposal['event'] = event
+                batch.append(proposal)
+                if len(batch) >= PAGE_SIZE:
+                    pages.put((event, batch))
+                    batch = []
+            pages.put((event, batch))
+        finally:
+            pages.put((event, None))  # this form is done
+
+    sources = {}
+    watermarks = {}
+    for event, (url, params) in forms.items():
+        params = dict(params)
+        params.pop('since', None)  # user filter, applied when loading
+        watermarks[event] = None if full else _get_meta(
+            conn, _watermark_key(event))
+        if watermarks[event]:
+            params['since'] = watermarks[event]
+        sources[event] = (url, params)
+
+    stored = 0
+    newest = {}
+    # one transaction, the watermarks only move once we have everything
+    with conn, ThreadPoolExecutor(max_workers=len(sources) or 1) as pool:
+        futures = [pool.submit(_fetch, event, url, params)
+                   for event, (url, params) in sources.items()]
+        try:
+            pending = len(futures)
+            while pending:
+                event, batch = pages.get()
+                if batch is None:
+                    pending -= 1
+                    continue
+                stored += _store_proposals(conn, batch)
+                if batch:
+                    latest = max(x['submitted'] for x in batch)
+                    newest[event] = max(latest, newest.get(event, latest))
+            for future in futures:
+                future.result()  # a failed form fails the whole sync
+        except BaseException:
+            stop.set()
+            raise
+
+        if stored:
+            _bump_version(conn)
+        for event, latest in newest.items():
+            # date_submit is naive UTC, mktime would read it as local
+            latest = calendar.timegm(latest.timetuple())
+            watermark = max(latest, int(watermarks[event] or 0))
+            _set_meta(conn, _watermark_key(event), watermark)
+        _set_meta(conn, 'last_sync', int(time.time()))
+
+    return stored
+
+
+def _count_proposals(conn, since=None, events=None):
+    """Same as len(_load_frame(...)) without building a DataFrame"""
+    where, args = _filter_clause(since, events)
+    return conn.execute('SELECT COUNT(*) FROM proposals' + where,
+                        args).fetchone()[0]
+
+
+def _count_events(conn, since=None, events=None):
+    """{event: proposal count}"""
+    where, args = _filter_clause(since, events)
+    return dict(conn.execute('SELECT event, COUNT(*) FROM proposals' + where +
+                             ' GROUP BY event ORDER BY event', args))
+
+
+@METRICS.timed('frame.load')
+def _load_frame(conn, since=None, events=None, fields=None):
+    """The stored proposals as a DataFrame, built column by column
+
+    sqlite pulls every field out of the stored json itself, so there's no
+    per-proposal python loop; LABEL_MAP is then applied once per distinct
+    value and the low-cardinality fields are kept as categoricals. The big
+    free text fields (abstract, bio) stay plain strings.
+
+    fields defaults to every field plus `event`; pass fewer to leave the
+    text out, see _Resources.
+    """
+    import pandas as pd
+
+    fields = fields or SESSION_FIELDS + SPEAKER_FIELDS + ['event']
+    where, args = _filter_clause(since, events)
+    query = 'SELECT _id, {} FROM proposals{} ORDER BY submitted'.format(
+        ', '.join('event' if x == 'event' else
+                  "json_extract(data, '$.{}')".format(x) for x in fields),
+        where)
+    proposals = pd.DataFrame.from_records(
+        conn.execute(query, args).fetchall(), columns=['_id'] + fields)
+    proposals = proposals.set_index('_id')
+    if 'submitted' in proposals:
+        proposals['submitted'] = pd.to_datetime(proposals['submitted'],
+                                                format=DT_FORMAT)
+    return _normalize_frame(proposals)
+
+
+@METRICS.timed('frame.normalize')
+def _normalize_frame(proposals):
+    import numpy as np
+    import pandas as pd
+
+    label_map = _get_label_map()
+    for field in proposals.columns:
+        if field == 'submitted':
+            continue
+        column = proposals[field].fillna("UNKNOWN")
+        mapping = label_map.get(field, {})
+        if field in CATEGORY_FIELDS:
+            column = column.astype('category')
+            # map the categories, not the cells
+            labels = [mapping.get(x, x) for x in column.cat.categories]
+            if len(set(labels)) == len(labels):
+                column = column.cat.rename_categories(labels)
+            else:
+                # some labels collapse into one, rebuild from the codes
+                labels = np.array(labels, dtype=object)
+                column = pd.Series(labels.take(column.cat.codes),
+                                   index=column.index, dtype='category')
+        elif mapping:
+            column = column.replace(mapping)
+        proposals[field] = column
     return proposals
 
 
@@ -172,44 +760,307 @@ def _convert_datetime(dt):
 
 
 def _split_resources(proposals):
-    # split out proposals into speakers and sessions
-    sessions = proposals[SESSION_FIELDS]
-    speakers = proposals[SPEAKER_FIELDS]
+    # split out proposals into speakers and sessions, with or without the
+    # TEXT_FIELDS
+    sessions = proposals[[x for x in SESSION_FIELDS if x in proposals]]
+    speakers = proposals[[x for x in SPEAKER_FIELDS if x in proposals]]
     return sessions, speakers
 
 
-def _download(url, path):
-    from io import open as iopen
+## Avatars ##
+
+PLACEHOLDER_AVATAR = "http://placehold.it/300x300"
+
+# leading bytes of the only image types we accept for avatars
+IMAGE_MAGIC = [
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8\xff', '.jpg'),
+]
+
+
+def _sniff_image(data):
+    for magic, ext in IMAGE_MAGIC:
+        if data.startswith(magic):
+            return ext
+    raise ValueError("Invalid image ({!r})".format(data[:16]))
+
+
+def _get_session(workers=8, per_host=4, retries=3):
+    """A pooled requests session shared by all the download workers"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    # pool_block caps the number of open connections per host
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=per_host,
+                          pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _AvatarCache(object):
+    """Content addressed avatar store living next to the downloaded avatars
+
+    Image bodies are kept once under .objects/<sha256><ext> and the
+    per-speaker files are hard links to them. The manifest remembers the
+    ETag / Last-Modified of every url so reruns can revalidate with a
+    conditional GET instead of downloading everything again.
+    """
+
+    MANIFEST = '.manifest.json'
+    OBJECTS = '.objects'
+
+    def __init__(self, path):
+        import threading
+
+        self.path = path
+        self.objects = os.path.join(path, self.OBJECTS)
+        self.manifest_path = os.path.join(path, self.MANIFEST)
+        self.lock = threading.Lock()
+        if not os.path.exists(self.objects):
+            os.makedirs(self.objects)
+        try:
+            self.manifest = json.load(open(self.manifest_path))
+        except Exception:
+            self.manifest = {}
+        self.manifest.setdefault('urls', {})
+        self.manifest.setdefault('files', {})
+
+    def _object_path(self, entry):
+        return os.path.join(self.objects, entry['sha256'] + entry['ext'])
+
+    def headers(self, url):
+        """Conditional request headers for url, if we have it cached"""
+        entry = self.manifest['urls'].get(url)
+        if not entry or not os.path.exists(self._object_path(entry)):
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def cached(self, url):
+        return self.manifest['urls'][url]
+
+    def store(self, url, response):
+        import hashlib
+        import tempfile
+
+        content = response.content
+        entry = {
+            'sha256': hashlib.sha256(content).hexdigest(),
+            'ext': _sniff_image(content),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        entry['type'] = entry['ext'].lstrip('.')
+        _path = self._object_path(entry)
+        if not os.path.exists(_path):
+            # write next to the target and rename, never leave half files;
+            # the temp name is unique as other threads may be storing the
+            # same body (ie the placeholder) right now
+            fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=self.objects)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp_path, 0o644)  # mkstemp makes it 0600
+            os.rename(tmp_path, _path)
+        with self.lock:
+            self.manifest['urls'][url] = entry
+        return entry
+
+    def link(self, url, entry, path):
+        """Point path + ext at the cached object, return the final path"""
+        source = self._object_path(entry)
+        _path = path + entry['ext']
+
+        if os.path.exists(_path) and os.path.samefile(source, _path):
+            return _path  # unchanged, nothing to do
+
+        # drop whatever we had before for this speaker (maybe other type)
+        for _, ext in IMAGE_MAGIC:
+            if os.path.lexists(path + ext):
+                os.remove(path + ext)
+        try:
+            os.link(source, _path)
+        except OSError:
+            shutil.copyfile(source, _path)  # ie, different filesystem
+
+        with self.lock:
+            self.manifest['files'][os.path.basename(path)] = {
+                'url': url, 'sha256': entry['sha256'], 'type': entry['type']}
+        return _path
+
+    def save(self):
+        with self.lock:
+            with open(self.manifest_path + '.part', 'w') as f:
+                json.dump(self.manifest, f, indent=2, sort_keys=True)
+            os.rename(self.manifest_path + '.part', self.manifest_path)
+
+
+@METRICS.timed('avatars.download')
+def _download(url, path, session=None, timeout=10, fallback=True,
+              cache=None):
+    """Save the image at url as path + .png/.jpg, return the final path
+
+    Anything that isn't a PNG or JPEG is replaced with the placeholder
+    avatar (once). Returns None if even that fails.
+    """
+    session = session or _get_session()
+    cache = cache or _AvatarCache(os.path.dirname(path))
 
     try:
-        i = requests.get(url)
-        if i.status_code == requests.codes.ok:
-            with iopen(path, 'wb') as file:
-                file.write(i.content)
-
-        cmd = "file {}".format(path)
-        process = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
-
-        output = str(output)
-        if re.search(r'PNG image', output):
-            ext = '.png'
-        elif re.search(r'JPEG image', output):
-            ext = '.jpg'
+        r = session.get(url, timeout=timeout, headers=cache.headers(url))
+        METRICS.incr('avatar_requests')
+        METRICS.incr('bytes_fetched', len(r.content))
+        _count_retries(r)
+        if r.status_code == 304:
+            entry = cache.cached(url)
         else:
-            raise ValueError("Invalid image ({})".format(output))
-        _path = path + ext
-        os.rename(path, _path)
+            r.raise_for_status()
+            entry = cache.store(url, r)
+        return cache.link(url, entry, path)
     except Exception as e:
-        if os.path.exists(path):
-            os.remove(path)
-        print("ERROR: {})\n".format(e))
-        url = "http://placehold.it/300x300"
-        path = path.split('.')[:-1] + '.png'
-        _download(url, path)
+        print("ERROR: {} ({})".format(e, url))
+        if fallback and url != PLACEHOLDER_AVATAR:
+            return _download(PLACEHOLDER_AVATAR, path, session=session,
+                             timeout=timeout, fallback=False, cache=cache)
+        return None
+
+
+def _download_all(avatars, path, workers=8, per_host=4, timeout=10,
+                  retries=3):
+    """Download {filename: url} into path concurrently"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    session = _get_session(workers=workers, per_host=per_host,
+                           retries=retries)
+    cache = _AvatarCache(path)
+
+    def _fetch(item):
+        filename, url = item
+        _path = _download(url, os.path.join(path, filename), session=session,
+                          timeout=timeout, cache=cache)
+        print("Loaded {} as {}".format(url, _path))
+        return filename, _path
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = dict(pool.map(_fetch, avatars.items()))
+    finally:
+        cache.save()
+        session.close()
+    return results
+
+
+@functools.lru_cache()
+def _image_engine():
+    """bin/process-images.py, which holds the avatar resizing code"""
+    import importlib.util
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'process-images.py')
+    spec = importlib.util.spec_from_file_location('process_images', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
 
 
-def _diff_submissions(path, wks_name, proposals):
+@METRICS.timed('avatars.process')
+def _process_avatar(url, filename, path, sizes, session, timeout=10,
+                    fallback=True):
+    """Download, validate and resize one avatar without touching the disk
+
+    Only the final SIZExSIZE jpegs are written, laid out like the output
+    of process-images.py. Bodies that can't be decoded are saved as is in
+    path/avatars-processed-bad. Returns (outputs, error).
+    """
+    import io
+
+    engine = _image_engine()
+
+    try:
+        r = session.get(url, timeout=timeout)
+        r.raise_for_status()
+        content = r.content
+        ext = _sniff_image(content)
+    except Exception as e:
+        print("ERROR: {} ({})".format(e, url))
+        if fallback and url != PLACEHOLDER_AVATAR:
+            return _process_avatar(PLACEHOLDER_AVATAR, filename, path, sizes,
+                                   session, timeout=timeout, fallback=False)
+        return [], str(e)
+
+    try:
+        image = engine.decode(io.BytesIO(content))
+        outputs = []
+        for size in sizes:
+            # same names as process-images.py gives the downloaded files
+            out_path = engine.variant_path(path, filename + ext, size)
+            engine.save(engine.render(image, size), out_path)
+            outputs.append(out_path)
+        return outputs, None
+    except Exception as e:
+        bad_dir = os.path.join(path, 'avatars-processed-bad')
+        with open(os.path.join(bad_dir, filename + ext), 'wb') as f:
+            f.write(content)
+        return [], '{}: {}'.format(type(e).__name__, e)
+
+
+def _process_all(avatars, path, sizes, workers=8, per_host=4, timeout=10,
+                 retries=3):
+    """_process_avatar() every {filename: url} concurrently
+
+    Returns {filename: outputs} and the failures, as process-images.py
+    reports them.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    for dir_name in ['{0}x{0}'.format(x) for x in sizes] + [
+            'avatars-processed-bad']:
+        if not os.path.exists(os.path.join(path, dir_name)):
+            os.makedirs(os.path.join(path, dir_name))
+
+    session = _get_session(workers=workers, per_host=per_host,
+                           retries=retries)
+
+    def _fetch(item):
+        filename, url = item
+        outputs, error = _process_avatar(url, filename, path, sizes, session,
+                                         timeout=timeout)
+        print("Processed {} as {}".format(url, filename))
+        return filename, url, outputs, error
+
+    done = {}
+    failures = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for filename, url, outputs, error in pool.map(
+                    _fetch, avatars.items()):
+                if error:
+                    failures.append({'file': filename, 'url': url,
+                                     'sizes': sizes, 'error': error})
+                else:
+                    done[filename] = outputs
+    finally:
+        session.close()
+
+    with open(os.path.join(path, 'avatars-processed-bad',
+                           'report.json'), 'w') as f:
+        json.dump(failures, f, indent=2)
+    return done, failures
+
+
+@METRICS.timed('sheets.open')
+def _open_worksheet(path, wks_name, write_access=False):
+    from df2gspread import df2gspread as d2g
+    from df2gspread.gfiles import get_file_id
+
     # access credentials
     credentials = d2g.get_credentials()
     # auth for gspread
@@ -221,27 +1072,225 @@ def _diff_submissions(path, wks_name, proposals):
         gfile_id = path
     except Exception:
         # else look for file_id in drive
-        gfile_id = get_file_id(credentials, path, write_access=True)
+        gfile_id = get_file_id(credentials, path, write_access=write_access)
 
-    wks = d2g.get_worksheet(gc, gfile_id, wks_name, write_access=True)
-    rows = wks.get_all_values()
-    try:
-        columns = rows.pop(0)  # header
-        df = pd.DataFrame(rows, columns=columns)
-        df = df.drop(['', 'COMMENTS', 'VOTES', 'PROPOSED TRACK(S)'], axis=1)
-        df = df[df['title'] != '']  # filter out empty rows
+    return d2g.get_worksheet(gc, gfile_id, wks_name,
+                             write_access=write_access)
+
+
+def _uploaded_ids(conn, sheet):
+    rows = conn.execute('SELECT _id FROM uploads WHERE sheet = ?', (sheet,))
+    return set(x[0] for x in rows)
 
-        rows_k = len(df)
-        start_cell = 'A' + str(rows_k + 2)
 
+@METRICS.timed('sheets.adopt')
+def _adopt_sheet(conn, sheet, wks, rows):
+    """One-off migration of a sheet uploaded before `_id`s were tracked
+
+    Those uploads wrote a 0..n index in column A and no `_id`, so the rows
+    are matched to the stored proposals on submitted + email, get their
+    `_id` written to column A and are recorded as uploaded. Refuses if the
+    sheet has rows but none of them match, rather than appending every
+    proposal a second time.
+    """
+    import pandas as pd
+    try:
+        from gspread.cell import Cell
+    except ImportError:  # gspread < 3.4
+        from gspread.models import Cell
+
+    def _key(submitted, email):
+        return (pd.to_datetime(submitted, errors='coerce'),
+                (email or '').strip().lower())
+
+    header = [x.strip() for x in rows[0]]
+    if 'submitted' in header and 'email' in header:
+        known = {}
+        for proposal in _load_proposals(conn):
+            known[_key(proposal['submitted'], proposal.get('email'))] = \
+                proposal['_id']
+        submitted, email = header.index('submitted'), header.index('email')
+        cells = []
+        for i, row in enumerate(rows[1:], 2):
+            if len(row) <= max(submitted, email):
+                continue
+            key = _key(row[submitted], row[email])
+            if key[0] is not pd.NaT and key[1] and key in known:
+                cells.append(Cell(i, 1, known[key]))
+    else:
+        cells = []
+    if not cells:
+        raise click.ClickException(
+            '{} already has {} rows but none match a stored proposal on '
+            'submitted + email; refusing to append every proposal again. '
+            'Check --path, or --full-sync if the store is missing '
+            'proposals.'.format(sheet, len(rows) - 1))
+
+    wks.update_cells(cells, value_input_option='RAW')
+    METRICS.incr('sheets_api_calls')
+    with conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO uploads (sheet, _id) VALUES (?, ?)',
+            [(sheet, x.value) for x in cells])
+    print('Matched {} of {} rows already in {} to their proposals'.format(
+        len(cells), len(rows) - 1, sheet))
+
+
+@METRICS.timed('sheets.diff')
+def _diff_submissions(conn, sheet, wks, proposals, verify=False):
+    """Pick the proposals that aren't in the sheet yet, by `_id`
+
+    The `_id`s already pushed are kept in the local store. With verify, the
+    sheet's id column (A, the DataFrame index) is fetched instead and the
+    local watermark is resynced from it, ie, after reviewers deleted rows.
+    A sheet filled before any of this (nothing logged, or no `_id` in
+    column A) is adopted first, see _adopt_sheet.
+    Returns the new proposals and whether the sheet still needs a header.
+    """
+    METRICS.incr('sheets_api_calls')
+    if verify:
+        ids = wks.col_values(1)
+        col_names = not ids
+        ids = set(x for x in ids[1:] if x)
+        stored = set(x[0] for x in conn.execute('SELECT _id FROM proposals'))
+        if ids and not ids & stored:
+            # column A is the old 0..n index
+            METRICS.incr('sheets_api_calls')
+            _adopt_sheet(conn, sheet, wks, wks.get_all_values())
+            ids = _uploaded_ids(conn, sheet)
+        else:
+            # keep the row hashes of what's still there
+            gone = _uploaded_ids(conn, sheet) - ids
+            with conn:
+                conn.executemany(
+                    'DELETE FROM uploads WHERE sheet = ? AND _id = ?',
+                    [(sheet, x) for x in gone])
+                conn.executemany(
+                    'INSERT OR IGNORE INTO uploads (sheet, _id) '
+                    'VALUES (?, ?)', [(sheet, x) for x in ids])
+    else:
+        ids = _uploaded_ids(conn, sheet)
         col_names = False
-        new_proposals = proposals[len(df.index):]
-        return start_cell, col_names, new_proposals
-    except Exception:
-        # new sheet, nothing to do
-        start_cell = 'A1'
-        col_names = True
-        return start_cell, col_names, proposals
+        if not ids:
+            # nothing logged yet, the sheet may still have rows
+            rows = wks.get_all_values()
+            col_names = not rows
+            if len(rows) > 1:
+                _adopt_sheet(conn, sheet, wks, rows)
+                ids = _uploaded_ids(conn, sheet)
+
+    new_proposals = proposals[~proposals.index.isin(ids)]
+    return new_proposals, col_names
+
+
+def _row_values(proposals):
+    """{_id: [cell, ...]} the way the rows are written to the sheet"""
+    return {_id: [str(x) for x in row] for _id, row in
+            zip(proposals.index, proposals.itertuples(index=False))}
+
+
+def _row_hash(values):
+    import hashlib
+
+    data = json.dumps(values, ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _record_rows(conn, sheet, rows):
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO uploads (sheet, _id, hash, data) '
+            'VALUES (?, ?, ?, ?)',
+            [(sheet, _id, _row_hash(values), json.dumps(values))
+             for _id, values in rows.items()])
+
+
+@METRICS.timed('sheets.append')
+def _append_submissions(conn, sheet, wks, proposals, col_names=False):
+    """Append proposals below the last row in a single batched write"""
+    rows = _row_values(proposals)
+    values = []
+    if col_names:
+        values.append([proposals.index.name or ''] + list(proposals.columns))
+    for _id in proposals.index:
+        values.append([_id] + rows[_id])
+
+    wks.append_rows(values, value_input_option='RAW')
+    METRICS.incr('sheets_api_calls')
+    _record_rows(conn, sheet, rows)
+
+
+def _changed_submissions(conn, sheet, proposals):
+    """Rows already in the sheet whose content changed since the upload
+
+    Returns {_id: (old values, new values)}. Rows uploaded before hashes
+    were kept have nothing to compare against; their current values are
+    taken as the baseline rather than overwriting what's in the sheet.
+    """
+    stored = {}
+    for _id, _hash, data in conn.execute(
+            'SELECT _id, hash, data FROM uploads WHERE sheet = ?', (sheet,)):
+        stored[_id] = (_hash, data)
+
+    rows = _row_values(proposals[proposals.index.isin(list(stored))])
+    changed = {}
+    baseline = {}
+    for _id, values in rows.items():
+        _hash, data = stored[_id]
+        if _hash is None:
+            baseline[_id] = values
+        elif _hash != _row_hash(values):
+            changed[_id] = (json.loads(data), values)
+    if baseline:
+        _record_rows(conn, sheet, baseline)
+    return changed
+
+
+@METRICS.timed('sheets.update')
+def _update_submissions(conn, sheet, wks, proposals, changed):
+    """Rewrite only the changed cells, in a single batched write
+
+    Cells are located through the sheet's header and id column, so rows
+    sorted or columns added by reviewers (COMMENTS, VOTES, ...) are fine;
+    only the columns we upload are ever written. Returns the cell count.
+    """
+    try:
+        from gspread.cell import Cell
+    except ImportError:  # gspread < 3.4
+        from gspread.models import Cell
+
+    header = wks.row_values(1)
+    METRICS.incr('sheets_api_calls', 2)
+    col_index = {name: i + 1 for i, name in enumerate(header) if name}
+    row_index = {_id: i + 1 for i, _id in enumerate(wks.col_values(1))
+                 if i and _id}
+
+    cells = []
+    updated = {}
+    for _id, (old, new) in changed.items():
+        row = row_index.get(_id)
+        if not row:
+            continue  # reviewers deleted it, leave it be
+        for name, before, after in zip(proposals.columns, old, new):
+            if before != after and name in col_index:
+                cells.append(Cell(row, col_index[name], after))
+        updated[_id] = new
+
+    if cells:
+        wks.update_cells(cells, value_input_option='RAW')
+        METRICS.incr('sheets_api_calls')
+    _record_rows(conn, sheet, updated)
+    return len(cells)
+
+
+def _sheet_columns(proposals):
+    """The proposals with the sheet's column layout
+
+    The sheet predates events and reviewers add their columns right after
+    ours, so `event` stays out of it; upload one event per sheet instead,
+    ie: --event devconf-us save --upload --path devconfus_proposals
+    """
+    return proposals.drop(columns=['event'], errors='ignore')
 
 
 def _get_type(_type):
@@ -261,20 +1310,9 @@ def _get_duration(_type):
 
 
 def _get_gspread(path, wks_name):
-    # access credentials
-    credentials = d2g.get_credentials()
-    # auth for gspread
-    gc = d2g.gspread.authorize(credentials)
+    import pandas as pd
 
-    try:
-        # if gfile is file_id
-        gc.open_by_key(path)
-        gfile_id = path
-    except Exception:
-        # else look for file_id in drive
-        gfile_id = get_file_id(credentials, path, write_access=False)
-
-    wks = d2g.get_worksheet(gc, gfile_id, wks_name, write_access=False)
+    wks = _open_worksheet(path, wks_name, write_access=False)
     rows = wks.get_all_values()
 
     columns = rows.pop(0)  # header
@@ -290,48 +1328,292 @@ def _get_gspread(path, wks_name):
     return df
 
 
+## Columnar Files ##
+#
+# Proposals can be saved as parquet / feather with real types and the big
+# csv exports the other commands chew on are cached as feather the first
+# time they are read. Later reads memory-map the file and only pull in the
+# columns asked for. Needs pyarrow; without it everything stays csv.
+
+TABLE_CACHE = os.path.join(BASE_PATH, 'cache')
+# feather schema metadata naming the column _write_table() kept the index in
+FEATHER_INDEX = b'typeform.index'
+
+
+def _typed_proposals(proposals):
+    """proposals with datetime `submitted` and categorical low-card fields"""
+    import pandas as pd
+
+    proposals = proposals.copy()
+    proposals['submitted'] = pd.to_datetime(proposals['submitted'],
+                                            errors='coerce')
+    for field in CATEGORY_FIELDS:
+        proposals[field] = proposals[field].astype('category')
+    return proposals
+
+
+def _write_table(df, path, fmt):
+    if fmt == 'csv':
+        df.to_csv(path)
+    elif fmt == 'parquet':
+        df.to_parquet(path)
+    elif fmt == 'feather':
+        import pyarrow
+        import pyarrow.feather
+
+        # feather can't store an index, keep it as a column
+        table = pyarrow.Table.from_pandas(df.reset_index(),
+                                          preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[FEATHER_INDEX] = (df.index.name or 'index').encode('utf-8')
+        table = table.replace_schema_metadata(metadata)
+        pyarrow.feather.write_feather(table, path)
+    else:
+        raise ValueError('Invalid format: {}'.format(fmt))
+
+
+def _read_columnar(path, columns=None):
+    import pyarrow.feather
+    import pyarrow.parquet
+
+    if path.endswith('.parquet'):
+        table = pyarrow.parquet.read_table(path, columns=columns,
+                                           memory_map=True)
+        return table.to_pandas()
+    table = pyarrow.feather.read_table(path, columns=columns,
+                                       memory_map=True)
+    df = table.to_pandas()
+    # undo the reset_index() from _write_table, other feather files (ie,
+    # the csv cache) are read as they are
+    index = (table.schema.metadata or {}).get(FEATHER_INDEX)
+    if index and index.decode('utf-8') in df.columns:
+        df = df.set_index(index.decode('utf-8'))
+    return df
+
+
+def _load_table(path, columns=None):
+    """Load a csv / parquet / feather table, only the given columns
+
+    csv files are converted to feather (under ~/.config/typeform/cache)
+    on first read and served from there until the csv changes.
+    """
+    import hashlib
+    import pandas as pd
+
+    path = os.path.expanduser(path)
+    if path.endswith(('.parquet', '.feather', '.arrow')):
+        return _read_columnar(path, columns)
+
+    try:
+        import pyarrow  # NOQA
+    except ImportError:
+        return pd.read_csv(path, usecols=columns)
+
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    cached = os.path.join(TABLE_CACHE, key + '.feather')
+    if (not os.path.exists(cached) or
+            os.path.getmtime(cached) < os.path.getmtime(path)):
+        df = pd.read_csv(path)
+        try:
+            if not os.path.exists(TABLE_CACHE):
+                os.makedirs(TABLE_CACHE)
+            df.to_feather(cached + '.part')
+            os.rename(cached + '.part', cached)
+        except Exception:
+            # ie, mixed types in a column, not worth caching
+            return df[columns] if columns else df
+    return _read_columnar(cached, columns)
+
+
 ## CLI Set-up ##
 
+class _Resources(dict):
+    """ctx.obj for all the commands
+
+    `proposals`, `sessions` and `speakers` are only fetched (and parsed) the
+    first time a command asks for them, then cached for the invocation.
+    """
+
+    def __init__(self, since=None, full_sync=False, events=None):
+        super().__init__()
+        self.since = since
+        self.full_sync = full_sync
+        self.events = events or None  # all of them
+        self.synced = False
+
+    def forms(self):
+        """{event: (url, params)} of the events we're working on"""
+        forms = _get_forms()
+        unknown = set(self.events or []) - set(forms)
+        if unknown:
+            raise click.BadParameter(
+                'no form for {} in the config (have: {})'.format(
+                    ', '.join(sorted(unknown)), ', '.join(forms)),
+                param_hint='--event')
+        return dict((k, v) for k, v in forms.items()
+                    if not self.events or k in self.events)
+
+    def sync(self, conn):
+        """Bring the local store up to date, once per invocation"""
+        if not self.synced:
+            _sync_store(conn, self.forms(), full=self.full_sync)
+            self.synced = True
+
+    def store(self):
+        """A connection to the (synced) local store"""
+        conn = _open_store()
+        try:
+            self.sync(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def version(self):
+        """Version of the synced dataset, changes whenever it does"""
+        conn = self.store()
+        try:
+            return _get_meta(conn, 'version', '0')
+        finally:
+            conn.close()
+
+    def with_text(self):
+        """The proposals along with their TEXT_FIELDS, in the usual order"""
+        proposals = self['proposals'].join(self['text'])
+        return proposals[[x for x in SESSION_FIELDS + SPEAKER_FIELDS +
+                          ['event'] if x in proposals]]
+
+    def __missing__(self, key):
+        # 'proposals' leaves out the TEXT_FIELDS, which are in 'text'
+        if key in ('proposals', 'text'):
+            fields = TEXT_FIELDS if key == 'text' else [
+                x for x in SESSION_FIELDS + SPEAKER_FIELDS + ['event']
+                if x not in TEXT_FIELDS]
+            conn = self.store()
+            try:
+                self[key] = _load_frame(conn, since=self.since,
+                                        events=self.events, fields=fields)
+            finally:
+                conn.close()
+        elif key in ('sessions', 'speakers'):
+            self['sessions'], self['speakers'] = _split_resources(
+                self['proposals'])
+        else:
+            raise KeyError(key)
+        return self[key]
+
+    def count(self, by_event=False):
+        if 'proposals' in self:
+            if by_event:
+                counts = self['proposals'].event.value_counts()
+                return dict((k, v) for k, v in sorted(counts.items()) if v)
+            return len(self['proposals'])
+        conn = self.store()
+        try:
+            if by_event:
+                return _count_events(conn, since=self.since,
+                                     events=self.events)
+            return _count_proposals(conn, since=self.since,
+                                    events=self.events)
+        finally:
+            conn.close()
+
+
 @click.group()
 @click.option('--since', default=None, help='Filter by submission date')
+@click.option('--full-sync', default=False, is_flag=True,
+              help='Ignore the local store watermark and refetch everything')
+@click.option('--event', 'events', multiple=True,
+              help='Only this event (a form name in the config), repeatable')
+@click.option('--profile', default=False, is_flag=True,
+              help='Print the time spent per phase and counters to stderr')
+@click.option('--metrics-out', default=None,
+              help='Write the spans and counters of the run to this file')
+@click.option('--metrics-format', default='json',
+              type=click.Choice(['json', 'prometheus']))
+@click.option('--cprofile', default=None,
+              help='Dump cProfile stats of the command to this file')
 @click.pass_context
-def cli(ctx, since):
+def cli(ctx, since, full_sync, events, profile, metrics_out, metrics_format,
+        cprofile):
     """Download and prepare the form responses for further processing"""
 
     # Apply Filters
     if since:
         # convert to UNIX timestamp
         since = _convert_datetime(since)
-        params['since'] = since
 
-    # MOVE TO _get_data... and call get_data in
-    # the cli funs that need it
-    # FIXME: This should run only when needed
-    #proposals = _get_data(url, params)
-    #sessions, speakers = _split_resources(proposals)
+    # the data is only fetched once a command actually asks for it
+    ctx.obj = _Resources(since=since, full_sync=full_sync,
+                         events=list(events))
+
+    if profile or metrics_out or cprofile:
+        METRICS.enabled = True
+        profiler = None
+        if cprofile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        ctx.call_on_close(functools.partial(
+            _write_metrics, ctx.invoked_subcommand, time.perf_counter(),
+            profile, metrics_out, metrics_format, profiler, cprofile))
+
+
+def _write_metrics(command, start, profile, metrics_out, metrics_format,
+                   profiler=None, cprofile=None):
+    """Runs once the command is done, even if it failed"""
+    import sys
+
+    METRICS.record('command.{}'.format(command), time.perf_counter() - start)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(cprofile)
+
+    if metrics_out:
+        with open(metrics_out + '.part', 'w') as f:
+            if metrics_format == 'prometheus':
+                f.write(METRICS.as_prometheus())
+            else:
+                json.dump(dict(METRICS.as_dict(), command=command), f,
+                          indent=2, sort_keys=True)
+        os.rename(metrics_out + '.part', metrics_out)
 
-    #ctx.obj['proposals'] = proposals
-    #ctx.obj['sessions'] = sessions
-    #ctx.obj['speakers'] = speakers
+    if profile:
+        print(METRICS.summary(), file=sys.stderr)
+        if profiler:
+            import pstats
+
+            print(file=sys.stderr)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                'cumulative').print_stats(15)
 
 
 @cli.command()
-@click.option('--csv', default=False, is_flag=True)
+@click.option('--csv', default=False, is_flag=True,
+              help='Save locally (as --format)')
+@click.option('--format', 'fmt', default='csv',
+              type=click.Choice(['csv', 'parquet', 'feather']))
 @click.option('--upload', default=False, is_flag=True,
               help='Save remotely to gspreadsheet?')
+@click.option('--verify', default=False, is_flag=True,
+              help='Check the ids in the sheet rather than trusting the '
+                   'local upload log')
 @click.option('--html', default=False, is_flag=True)
 @click.option('--path', help='Output directory')
 @click.pass_obj
-def save(obj, csv, upload, html, path):
-    proposals = obj['proposals']
+def save(obj, csv, fmt, upload, verify, html, path):
+    proposals = full = obj.with_text()
     if not (csv or upload or html):
         csv = True
 
     if csv:
-        path = path or './'
-        path = os.path.join(path, "devconfcz_proposals.csv")
-        f = open(path, 'w')
-        proposals.to_csv(f)
+        out_path = os.path.join(path or './',
+                                "devconfcz_proposals." + fmt)
+        if fmt != 'csv':
+            proposals = _typed_proposals(proposals)
+        _write_table(proposals, out_path, fmt)
+        proposals = full
 
     if upload:
         path = path or 'devconfcz_proposals'
@@ -341,13 +1623,27 @@ def save(obj, csv, upload, html, path):
         # grab only the items we don't already have so we
         # can APPEND them to the sheet rather than rewritting
         # the whole sheet
-        start_cell, col_names, proposals = _diff_submissions(path, wks,
-                                                             proposals)
-        if not proposals.empty:
-            d2g.upload(proposals, path, wks, start_cell=start_cell,
-                       clean=False, col_names=col_names)
-        else:
-            print("No new proposals to upload... QUITTING!")
+        sheet = '{}/{}'.format(path, wks)
+        wks = _open_worksheet(path, wks, write_access=True)
+        proposals = _sheet_columns(proposals)
+        conn = _open_store()
+        try:
+            new, col_names = _diff_submissions(conn, sheet, wks, proposals,
+                                               verify=verify)
+            changed = _changed_submissions(conn, sheet, proposals)
+            if changed:
+                cells = _update_submissions(conn, sheet, wks, proposals,
+                                            changed)
+                print("Updated {} cells in {} changed proposals".format(
+                    cells, len(changed)))
+            if not new.empty:
+                _append_submissions(conn, sheet, wks, new,
+                                    col_names=col_names)
+                print("Uploaded {} new proposals".format(len(new)))
+            elif not changed:
+                print("No new or changed proposals to upload... QUITTING!")
+        finally:
+            conn.close()
 
     if html:
         print(proposals.style.render())
@@ -356,92 +1652,395 @@ def save(obj, csv, upload, html, path):
 @cli.command()
 @click.argument('resource', default='sessions',
                 type=click.Choice(['sessions', 'speakers', 'proposals']))
+@click.option('--by-event', default=False, is_flag=True,
+              help='One count per event')
 @click.pass_obj
-def count(obj, resource):
-    resources = obj[resource]
-    click.echo(len(resources))
+def count(obj, resource, by_event):
+    # sessions and speakers are just column subsets of the proposals
+    if by_event:
+        for event, total in obj.count(by_event=True).items():
+            click.echo('{:<20} {}'.format(event, total))
+        return
+    click.echo(obj.count())
 
 
 @cli.command()
 @click.option('--path', help='Output Path')
+@click.option('--workers', default=8, help='Parallel downloads')
+@click.option('--per-host', default=4, help='Max connections per host')
+@click.option('--timeout', default=10, help='Per request timeout (seconds)')
+@click.option('--retries', default=3, help='Retries per avatar')
+@click.option('--sizes', default=None,
+              help='Comma separated sizes, ie 100,300: write only the '
+                   'resized jpegs (like process-images.py) straight from '
+                   'the download')
 @click.pass_obj
-def avatars(obj, path):
+def avatars(obj, path, workers, per_host, timeout, retries, sizes):
     path = os.path.expanduser(path or "/tmp/avatars")
 
     if not os.path.exists(path):
         os.makedirs(path)
 
+    avatars = {}
     for row in obj['speakers'][['email', 'avatar']].itertuples():
-        email, url = row.email.replace('@', '__at__'), row.avatar
-        print("Loading {} ".format(url), end="", flush=True)  # NOQA
-        filename = email
-        _path = os.path.join(path, filename)
-        print("as {} ".format(filename))
-        _download(url, _path)
+        avatars[row.email.replace('@', '__at__')] = row.avatar
+
+    if sizes:
+        sizes = [int(x) for x in sizes.split(',')]
+        done, failures = _process_all(avatars, path, sizes, workers=workers,
+                                      per_host=per_host, timeout=timeout,
+                                      retries=retries)
+        print("Processed {} of {} avatars".format(len(done), len(avatars)))
+        for failure in failures:
+            print("FAILED: {file} ({error})".format(**failure))
+        return
+
+    results = _download_all(avatars, path, workers=workers,
+                            per_host=per_host, timeout=timeout,
+                            retries=retries)
+    failed = sorted(k for k, v in results.items() if not v)
+    print("Downloaded {} of {} avatars".format(
+        len(results) - len(failed), len(results)))
+    for filename in failed:
+        print("FAILED: {}".format(filename))
+
+
+REPORT_DIMS = ['theme', 'difficulty', 'country', 'org', 'type', 'duration',
+               'event']
+# also fine to ask for, but not part of `report all`
+REPORT_CHOICES = REPORT_DIMS + ['name', 'title']
+REPORT_CACHE = os.path.join(BASE_PATH, 'cache')
+
+
+def _get_durations(types):
+    """Vectorized _get_duration, NaN for custom types (ie "meetup")"""
+    import pandas as pd
+
+    minutes = types.str.split(' ').str[-1].str.split('+').str[0]
+    return pd.to_numeric(minutes.str.rstrip('m'), errors='coerce')
+
+
+def _report_column(proposals, dim):
+    import pandas as pd
+
+    # themes are '; ' joined lists, one row per theme
+    if dim == 'theme':
+        return proposals.theme.str.split('; ').explode()
+    if dim == 'duration':
+        # minutes of each proposal, in order, custom types are 'unknown'
+        minutes = _get_durations(proposals['type'])
+        labels = ['{:.0f}m'.format(x)
+                  for x in sorted(minutes.dropna().unique())]
+        if minutes.isnull().any():
+            labels.append('unknown')
+        column = minutes.map('{:.0f}m'.format, na_action='ignore')
+        return column.fillna('unknown').astype(
+            pd.CategoricalDtype(labels, ordered=True))
+    return proposals[dim]
+
+
+@METRICS.timed('report.build')
+def _build_report(proposals, dims=REPORT_DIMS, crosstabs=()):
+    """All the requested counts in one go
+
+    Returns {dim: counts Series, 'duration': {...},
+             'a x b': crosstab DataFrame}
+    """
+    import pandas as pd
+
+    report = {}
+    for dim in dims:
+        if dim == 'duration':
+            durations = _get_durations(proposals['type'])
+            report[dim] = {'minutes': int(durations.sum()),
+                           'unknown': int(durations.isnull().sum())}
+        else:
+            report[dim] = _report_column(proposals, dim).value_counts()
+
+    for a, b in crosstabs:
+        # explode the themes first so each gets crossed with the rest
+        pairs = pd.DataFrame({a: _report_column(proposals, a)})
+        pairs = pairs.join(pd.DataFrame({b: _report_column(proposals, b)}))
+        report['{} x {}'.format(a, b)] = pd.crosstab(
+            pairs[a].values, pairs[b].values, rownames=[a], colnames=[b])
+
+    return report
+
+
+def _cached_report(obj, dims, crosstabs):
+    """_build_report() cached on disk per dataset version"""
+    import glob
+    import hashlib
+    import pickle
+
+    def _digest(*args):
+        key = json.dumps(args, sort_keys=True).encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    # one entry per report asked for, named after the dataset it was built
+    # from; labels are mapped when loading, so a new label map is a new
+    # dataset
+    prefix = os.path.join(REPORT_CACHE, 'report-{}-'.format(
+        _digest(obj.since, obj.events, dims, crosstabs)))
+    path = prefix + _digest(obj.version(), _get_label_map()) + '.pickle'
+    try:
+        return pickle.load(open(path, 'rb'))
+    except Exception:
+        pass
+
+    report = _build_report(obj['proposals'], dims, crosstabs)
+    if not os.path.exists(REPORT_CACHE):
+        os.makedirs(REPORT_CACHE)
+    with open(path + '.part', 'wb') as f:
+        pickle.dump(report, f)
+    os.rename(path + '.part', path)
+    # the same report of an older dataset won't be asked for again
+    for stale in glob.glob(prefix + '*.pickle'):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass  # another run got to it first
+    return report
 
 
 @cli.command()
-@click.argument('cmd', default='theme',
-                type=click.Choice(['theme', 'difficulty', 'country',
-                                   'org', 'name', 'type', 'title']))
+@click.argument('dims', nargs=-1,
+                type=click.Choice(['all'] + REPORT_CHOICES))
+@click.option('--crosstab', multiple=True,
+              help='Cross tabulate two dimensions, ie: theme,difficulty')
 @click.option('--sort', default=1, help="Sort key")
 @click.pass_obj
-def report(obj, cmd, sort):
-    proposals = obj['proposals']
-
-    stuff = []
-    if cmd == 'theme':
-        _types = proposals.theme
-        _types.apply(lambda x: stuff.extend(x.split('; ')))
-    elif cmd in ['difficulty', 'country', 'org', 'name', 'type', 'title']:
-        _types = proposals[cmd]
-        _types.apply(lambda x: stuff.append(x))
-    else:
-        raise ValueError('Invalid command: {}'.format(cmd))
-
-    stuff = dict(Counter(stuff))
-
-    for k, v in sorted(stuff.items(), key=lambda x: x[sort], reverse=True):
-        print("{:<40}: {}".format(k[:40], v))
+def report(obj, dims, crosstab, sort):
+    """Counts per theme, difficulty, ... (default: theme)"""
+    dims = list(dims or ([] if crosstab else ['theme']))
+    if 'all' in dims:
+        dims = REPORT_DIMS
+    elif 'type' in dims and 'duration' not in dims:
+        dims.append('duration')  # type always came with the total duration
+
+    crosstabs = []
+    for pair in crosstab:
+        pair = [x.strip() for x in pair.split(',')]
+        if len(pair) != 2:
+            raise click.BadParameter('expected two comma separated '
+                                     'dimensions, got {}'.format(pair),
+                                     param_hint='--crosstab')
+        unknown = [x for x in pair if x not in REPORT_CHOICES]
+        if unknown:
+            raise click.BadParameter('unknown dimension {}, expected one of '
+                                     '{}'.format(unknown[0],
+                                                 ', '.join(REPORT_CHOICES)),
+                                     param_hint='--crosstab')
+        if pair[0] == pair[1]:
+            raise click.BadParameter('can\'t cross {} with itself'.format(
+                pair[0]), param_hint='--crosstab')
+        crosstabs.append(pair)
+
+    report = _cached_report(obj, dims, crosstabs)
+
+    for dim in dims:
+        if dim == 'duration':
+            duration = report[dim]
+            print("Total duration: ~{} hours ({} of unknown length)".format(
+                int(duration['minutes'] / 60), duration['unknown']))
+            continue
+        if len(dims) > 1:
+            print('== {} =='.format(dim))
+        counts = report[dim].to_dict()
+        for k, v in sorted(counts.items(), key=lambda x: x[sort],
+                           reverse=True):
+            print("{:<40}: {}".format(str(k)[:40], v))
+        if len(dims) > 1:
+            print()
 
-    if cmd == 'type':
-        duration = 0
-        for value in proposals['type']:
-            duration += _get_duration(value)
-        else:
-            duration = int(duration / 60)
-        print("Total duration: ~{} hours".format(duration))
+    for a, b in crosstabs:
+        print('== {} x {} =='.format(a, b))
+        print(report['{} x {}'.format(a, b)].to_string())
+        print()
 
 
 @cli.command()
-@click.argument('column', type=click.Choice(ALL_FIELDS))
+@click.argument('column', type=click.Choice(['all'] + ALL_FIELDS))
 @click.argument('query', nargs=-1)
+@click.option('--limit', default=20, help='Max results')
+@click.option('--sync', default=False, is_flag=True,
+              help='Fetch new responses before searching')
 @click.pass_obj
-def search(obj, column, query):
-    proposals = obj['proposals']
-
+def search(obj, column, query, limit, sync):
+    """Search proposals, ie: search all "openshift on" contain*"""
     # slup all the query args and create a single spaced string from it
     query = ' '.join(query)
+    # only tell the events apart when there's more than one
+    multi = len(obj.forms()) > 1
+
+    if column == 'all' or column in SEARCH_FIELDS:
+        conn = _open_store()
+        try:
+            empty = not conn.execute('SELECT 1 FROM proposals').fetchone()
+            if sync or empty:
+                obj.sync(conn)
+            column = None if column == 'all' else column
+            results = _search(conn, query, column=column, since=obj.since,
+                              limit=limit, events=obj.events)
+        finally:
+            conn.close()
+        for score, proposal in results:
+            event = '{:<12} '.format(proposal['event']) if multi else ''
+            print('{:>6.2f}  {}{:<30} {}'.format(
+                score, event, proposal.get('name', 'UNKNOWN')[:30],
+                proposal.get('title', 'UNKNOWN')))
+        return
+
+    # fields outside the index (email, country, ...) are rare enough
+    proposals = obj['proposals']
 
-    result = proposals[proposals[column].str.contains(query, na=False)]
+    result = proposals[proposals[column].str.contains(query, na=False,
+                                                      regex=False)]
 
-    print(result[['name', 'title']])
+    print(result[(['event'] if multi else []) + ['name', 'title']])
 
 
-import httplib2
-import os
-import oauth2client
-from oauth2client import client, tools
-import base64
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from apiclient import errors, discovery
+## Near-duplicate Detection ##
+#
+# Proposals are shingled (word 3-grams of title + abstract), turned into
+# MinHash signatures and bucketed with LSH, so only proposals sharing a
+# bucket are ever compared. Candidates are then checked with the exact
+# Jaccard similarity of their shingles.
+
+MINHASH_PRIME = 4294967311  # first prime > 2 ** 32
+SHINGLE_SIZE = 3  # words
+
+
+def _shingles(text, k=SHINGLE_SIZE):
+    import unicodedata
+
+    # fold case and diacritics, keep only the words
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    words = re.findall(r'\w+', text)
+    if len(words) < k:
+        return set([' '.join(words)]) if words else set()
+    return set(' '.join(words[i:i + k]) for i in range(len(words) - k + 1))
+
+
+def _lsh_bands(num_perm, threshold):
+    """The (bands, rows) split whose LSH threshold is closest to ours"""
+    splits = [(num_perm // r, r) for r in range(1, num_perm + 1)
+              if num_perm % r == 0]
+    return min(splits, key=lambda x: abs((1.0 / x[0]) ** (1.0 / x[1]) -
+                                         threshold))
+
+
+def _minhash(shingles, a, b):
+    import numpy as np
+    import zlib
+
+    if not shingles:
+        return np.full(len(a), MINHASH_PRIME, dtype=np.uint64)
+    hashes = np.array([zlib.crc32(x.encode('utf-8')) for x in shingles],
+                      dtype=np.uint64)
+    # a, b and the hashes are all < 2 ** 32, so this can't overflow
+    return ((np.outer(a, hashes) + b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+
+@METRICS.timed('dupes.find')
+def _find_duplicates(proposals, threshold=0.5, num_perm=128, seed=1):
+    """Clusters of near-duplicate proposals
+
+    Returns a list of clusters, each a list of (_id, _id, similarity)
+    pairs, biggest cluster first, and the _ids of the proposals with too
+    little text to tell (ie, an empty or UNKNOWN abstract), which are left
+    out rather than all matching each other.
+    """
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2 ** 32, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, 2 ** 32, size=num_perm, dtype=np.uint64)
+    bands, rows = _lsh_bands(num_perm, threshold)
+
+    texts = proposals.title.astype(str) + ' ' + proposals.abstract.astype(str)
+    shingles = {}
+    skipped = []
+    for _id, text in texts.items():
+        _shingles_ = _shingles(text)
+        if len(_shingles_) < SHINGLE_SIZE:
+            skipped.append(_id)
+        else:
+            shingles[_id] = _shingles_
+
+    buckets = defaultdict(list)
+    for _id, _shingles_ in shingles.items():
+        signature = _minhash(_shingles_, a, b)
+        for band in range(bands):
+            key = signature[band * rows:(band + 1) * rows].tobytes()
+            buckets[(band, key)].append(_id)
+
+    candidates = set()
+    for ids in buckets.values():
+        for i in range(len(ids)):
+            for j in range(i + 1, len(ids)):
+                candidates.add(tuple(sorted((ids[i], ids[j]))))
+
+    # union-find over the confirmed pairs
+    parent = {}
+
+    def _root(x):
+        while parent.get(x, x) != x:
+            x = parent[x]
+        return x
+
+    pairs = []
+    for x, y in candidates:
+        sx, sy = shingles[x], shingles[y]
+        similarity = float(len(sx & sy)) / len(sx | sy)
+        if similarity >= threshold:
+            pairs.append((x, y, similarity))
+            parent[_root(x)] = _root(y)
+
+    clusters = defaultdict(list)
+    for pair in sorted(pairs, key=lambda p: -p[2]):
+        clusters[_root(pair[0])].append(pair)
+    return (sorted(clusters.values(), key=lambda c: (-len(c), c[0][0])),
+            skipped)
+
+
+@cli.command()
+@click.option('--threshold', default=0.5,
+              help='Min jaccard similarity of title + abstract')
+@click.option('--num-perm', default=128, help='MinHash permutations')
+@click.pass_obj
+def dupes(obj, threshold, num_perm):
+    """Find near-duplicate submissions"""
+    proposals = obj['proposals'].join(obj['text'][['abstract']])
+
+    clusters, skipped = _find_duplicates(proposals, threshold=threshold,
+                                         num_perm=num_perm)
+    for i, cluster in enumerate(clusters, 1):
+        ids = sorted(set(x for pair in cluster for x in pair[:2]))
+        print('Cluster {} ({} proposals)'.format(i, len(ids)))
+        for _id in ids:
+            row = proposals.loc[_id]
+            print('  {:<30} {:<30} {}'.format(
+                _id[:30], str(row['name'])[:30], row['title']))
+        for x, y, similarity in cluster:
+            print('    {:.2f}  {} ~ {}'.format(similarity, x, y))
+        print()
+    print('{} clusters found'.format(len(clusters)))
+    if skipped:
+        print('{} proposals with too little text to compare: {}'.format(
+            len(skipped), ', '.join(sorted(skipped))))
+
 
 SCOPES = 'https://www.googleapis.com/auth/gmail.send'
 CLIENT_SECRET_FILE = '/home/cward/Downloads/client_secret.json'
 APPLICATION_NAME = 'Gmail API Python Send Email'
 
 def get_credentials():
+    import oauth2client.file
+    from oauth2client import client, tools
+
     home_dir = os.path.expanduser('~')
     credential_dir = os.path.join(home_dir, '.credentials')
     if not os.path.exists(credential_dir):
@@ -456,43 +2055,300 @@ def get_credentials():
         print('Storing credentials to ' + credential_path)
     return credentials
 
-def SendMessage(sender, to, subject, msgHtml, msgPlain):
-    credentials = get_credentials()
+def _get_gmail_service(credentials=None):
+    import httplib2
+    from apiclient import discovery
+
+    credentials = credentials or get_credentials()
     http = credentials.authorize(httplib2.Http())
-    service = discovery.build('gmail', 'v1', http=http)
-    message1 = CreateMessage(sender, to, subject, msgHtml, msgPlain)
-    SendMessageInternal(service, "me", message1)
+    return discovery.build('gmail', 'v1', http=http)
 
-def SendMessageInternal(service, user_id, message):
-    try:
-        message = (service.users().messages().send(userId=user_id, body=message).execute())
-        print('Message Id: %s' % message['id'])
-        return message
-    except errors.HttpError as error:
-        print('An error occurred: %s' % error)
 
-def CreateMessage(sender, to, subject, msgHtml, msgPlain):
+def _build_mime(sender, to, subject, msgHtml, msgPlain):
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject
     msg['From'] = sender
     msg['To'] = to
     msg.attach(MIMEText(msgPlain, 'plain'))
     msg.attach(MIMEText(msgHtml, 'html'))
+    return msg
+
+def CreateMessage(sender, to, subject, msgHtml, msgPlain):
+    import base64
+
+    msg = _build_mime(sender, to, subject, msgHtml, msgPlain)
     raw = base64.urlsafe_b64encode(msg.as_bytes())
     raw = raw.decode()
     body = {'raw': raw}
     return body
 
 
+## Mail Transport ##
+#
+# Messages are plain dicts with sender, to, subject, html and plain keys.
+# A transport sends a batch of them and returns one (message id, error)
+# pair per message. _send_all() drives a transport with rate limiting,
+# bounded concurrency and a journal so a crashed run can be resumed.
+
+class GmailTransport(object):
+    """Gmail API, sending each batch as a single batched http request"""
+
+    def __init__(self, user_id='me'):
+        import threading
+
+        self.user_id = user_id
+        # up front, so a missing token is one oauth flow and not one per
+        # worker; the service is still per thread, httplib2 isn't thread
+        # safe
+        self.credentials = get_credentials()
+        self.local = threading.local()
+
+    @property
+    def service(self):
+        if not hasattr(self.local, 'service'):
+            self.local.service = _get_gmail_service(self.credentials)
+        return self.local.service
+
+    def send_batch(self, messages):
+        # a message the batch never answered for wasn't sent, it's only
+        # marked sent (and journaled) from its own callback
+        results = [(None, 'no response')] * len(messages)
+
+        def _callback(request_id, response, exception):
+            i = int(request_id)
+            if exception is not None:
+                results[i] = (None, str(exception))
+            else:
+                results[i] = (response['id'], None)
+
+        batch = self.service.new_batch_http_request(callback=_callback)
+        for i, m in enumerate(messages):
+            body = CreateMessage(m['sender'], m['to'], m['subject'],
+                                 m['html'], m['plain'])
+            batch.add(self.service.users().messages().send(
+                userId=self.user_id, body=body), request_id=str(i))
+        batch.execute()
+        METRICS.incr('gmail_api_calls')
+        return results
+
+    def close(self):
+        pass
+
+
+class SMTPTransport(object):
+    """Plain SMTP, one connection per worker thread"""
+
+    def __init__(self, host='localhost', port=25, user=None, password=None,
+                 starttls=False):
+        import threading
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.local = threading.local()
+        self.connections = []
+
+    def _connect(self):
+        import smtplib
+
+        if not hasattr(self.local, 'smtp'):
+            smtp = smtplib.SMTP(self.host, self.port)
+            if self.starttls:
+                smtp.starttls()
+            if self.user:
+                smtp.login(self.user, self.password)
+            self.local.smtp = smtp
+            self.connections.append(smtp)
+        return self.local.smtp
+
+    def send_batch(self, messages):
+        from email.utils import make_msgid
+
+        smtp = self._connect()
+        results = []
+        for m in messages:
+            msg = _build_mime(m['sender'], m['to'], m['subject'], m['html'],
+                              m['plain'])
+            # journaled as the message id, unique even for the same `to`
+            msg['Message-ID'] = make_msgid()
+            try:
+                smtp.send_message(msg)
+                results.append((msg['Message-ID'], None))
+            except Exception as e:
+                results.append((None, str(e)))
+        return results
+
+    def close(self):
+        for smtp in self.connections:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+
+
+class FileTransport(object):
+    """Local sink, writes every message as an .eml file into path"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def send_batch(self, messages):
+        results = []
+        for m in messages:
+            msg = _build_mime(m['sender'], m['to'], m['subject'], m['html'],
+                              m['plain'])
+            name = '{}.eml'.format(_message_key(m)[:16])
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(msg.as_bytes())
+            results.append((name, None))
+        return results
+
+    def close(self):
+        pass
+
+
+class _TokenBucket(object):
+    """Allow `rate` tokens per second, with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=None):
+        import threading
+
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        n = min(n, self.burst)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class _SendJournal(object):
+    """Append only log of the messages already sent (one json per line)"""
+
+    def __init__(self, path):
+        import threading
+
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.sent = set()
+        if os.path.exists(self.path):
+            for line in open(self.path):
+                try:
+                    self.sent.add(json.loads(line)['key'])
+                except ValueError:
+                    pass  # torn last line from a crash
+        self.f = open(self.path, 'a')
+
+    def __contains__(self, key):
+        return key in self.sent
+
+    def record(self, key, to, message_id):
+        with self.lock:
+            self.sent.add(key)
+            self.f.write(json.dumps({'key': key, 'to': to, 'id': message_id,
+                                     'sent': int(time.time())}) + '\n')
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+def _message_key(message):
+    import hashlib
+
+    key = '{}|{}'.format(message['to'], message['subject'])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+@METRICS.timed('mail.send_all')
+def _send_all(transport, messages, journal, rate=5, batch_size=20,
+              workers=2):
+    """Send all messages not yet in the journal, return the failures"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    pending = [m for m in messages if _message_key(m) not in journal]
+    skipped = len(messages) - len(pending)
+    if skipped:
+        print('Skipping {} messages already sent'.format(skipped))
+
+    bucket = _TokenBucket(rate, burst=batch_size)
+    batches = [pending[i:i + batch_size]
+               for i in range(0, len(pending), batch_size)]
+    failures = []
+
+    def _send(batch):
+        bucket.take(len(batch))
+        try:
+            results = transport.send_batch(batch)
+        except Exception as e:
+            results = [(None, str(e))] * len(batch)
+        for m, (message_id, error) in zip(batch, results):
+            if error:
+                print('FAILED [{}]: {}'.format(m['to'], error))
+                METRICS.incr('mails_failed')
+                failures.append((m, error))
+            else:
+                journal.record(_message_key(m), m['to'], message_id)
+                METRICS.incr('mails_sent')
+                print('Sent [{}] {}'.format(m['to'], message_id))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_send, batches))
+    finally:
+        transport.close()
+    return failures
+
+
 @cli.command()
+@click.option('--dry-run', default=False, is_flag=True,
+              help='Print the mails instead of sending them')
+@click.option('--with-rejected', default=False, is_flag=True,
+              help='Also send the rejection mails')
+@click.option('--transport', default='gmail',
+              type=click.Choice(['gmail', 'smtp', 'file']))
+@click.option('--smtp-host', default='localhost')
+@click.option('--smtp-port', default=25)
+@click.option('--outbox', default='/tmp/outbox',
+              help='Output directory for --transport file')
+@click.option('--journal', default=os.path.join(BASE_PATH, 'sent.jsonl'),
+              help='Sent mail journal, reruns skip anything logged here')
+@click.option('--rate', default=5.0, help='Max messages per second')
+@click.option('--batch-size', default=20, help='Messages per batch request')
+@click.option('--workers', default=2, help='Batches sent in parallel')
 @click.pass_obj
-def email(obj):
-    speakers_db = pd.read_csv(
-        '/home/cward/Downloads/DevConf.cz - MASTER db - speakers.csv')
-    submissions_db = pd.read_csv(
-        '/home/cward/Downloads/DevConf.cz - MASTER db - submissions.csv')
-    sched = pd.read_csv('/home/cward/Downloads/DevConf.cz 2017 - Program Draft - All Sessions.csv')
-    cfp_db = pd.read_csv('/home/cward/Downloads/Devconf.cz CfP Submissions - SOURCE - CLEAN Talks MASTER.csv')
+def email(obj, dry_run, with_rejected, transport, smtp_host, smtp_port,
+          outbox, journal, rate, batch_size, workers):
+    speakers_db = _load_table(
+        '/home/cward/Downloads/DevConf.cz - MASTER db - speakers.csv',
+        ['email', 'name', 'country', 'org', 'size', 'twitter', 'avatar',
+         'bio'])
+    submissions_db = _load_table(
+        '/home/cward/Downloads/DevConf.cz - MASTER db - submissions.csv',
+        ['id', 'difficulty', 'abstract'])
+    sched = _load_table('/home/cward/Downloads/DevConf.cz 2017 - Program Draft - All Sessions.csv')
+    cfp_db = _load_table('/home/cward/Downloads/Devconf.cz CfP Submissions - SOURCE - CLEAN Talks MASTER.csv',
+                         ['id', 'email', 'title'])
 
     split_speakers = lambda x: [y.strip() for y in x.split(';')]
     # make the list of speakers a list of speakers
@@ -538,44 +2394,24 @@ Bio:
     {}
 '''
 
-    print('ACCEPTED' + '*' * 79)
-    # Get a dict of all accepted speaker ids reverse linked to session ids
-    accepted = set()
-    speaker_sessions = defaultdict(list)
-    for row in sched.iterrows():
-        row = row[1].to_dict()
-        accepted.add(int(row['session_id']))
-        speakers = row['speakers']
-        # gather all the speaker details for the given speakers in each session
-        speaker_details = []
-        # first, gather all the speaker details for all speakers in the session
-        for spkr in speakers:
-            spkr = speakers_db[speakers_db.email == spkr].T.to_dict()
-            if not spkr:
-                continue
-            spkr = spkr.popitem()[1]
-            speaker_details.append(spkr)
+    accepted, rejected = _build_mailing(speakers_db, submissions_db, sched,
+                                        cfp_db)
 
-        # then, combine those speaker details with the session details
-        for spkr in speakers:
-            speaker_sessions[spkr].append((row, speaker_details))
+    messages = []
 
-    x = 1
-    y = len(speaker_sessions)
-    for speaker, data in speaker_sessions.items():
+    for speaker, data in sorted(accepted.items()):
         if speaker == 'shadowman': continue
 
         all_sessions = ''
         for _sess, _spkrs in data:
             title = _sess['title']
             _type = _sess['type']
-            level = submissions_db[submissions_db['id'] == _sess['session_id']].difficulty.values[0]
+            level = _sess['submission_difficulty']
             track = _sess['track']
             _start = _sess['session_duration'].split(':')[1]
-            _qa = _sess['session_qa'].split(':')[1]
+            _qa = _sess.get('session_qa', 'qa:0').split(':')[1]
             duration = int(_start) + int(_qa)
-            abstract = submissions_db[submissions_db['id'] == _sess['session_id']].abstract.values[0]
-            #import ipdb; ipdb.set_trace()
+            abstract = _sess['submission_abstract']
             _sess_str = _sess_template.format(
                 title, _type, track, level, duration, abstract)
             _sess_spkrs_str = ''
@@ -603,29 +2439,13 @@ Bio:
         subject = subject.format(speaker)
         msgHtml = body.replace('\n', '<br>')
         msgPlain = body
-        print('Sending {} of {} [{}]'.format(x, y, speaker))
-        x += 1
-        # confirm before sending
-        SendMessage(sender, to, subject, msgHtml, msgPlain)
-        time.sleep(.1)
-        #print(body)
-
-    print('REJECTED' + '*' * 79)
-    # now send rejection letters
-    all_submissions = set([int(x) for x in cfp_db.id.values])
-    rejected = defaultdict(list)
-    for i in all_submissions:
-        spkr = cfp_db[cfp_db.id == i].email.values[0]
-        if i not in accepted:
-            rejected[spkr].append(i)
-
-    x = 1
-    y = len(rejected)
-    for spkr, session_ids in rejected.items():
+        messages.append({'sender': sender, 'to': to, 'subject': subject,
+                         'html': msgHtml, 'plain': msgPlain})
+
+    # now the rejection letters
+    for spkr, submissions in sorted(rejected.items()):
         body = 'Rejected submission titles\n==========================\n\n'
-        for i in session_ids:
-            submission = cfp_db[cfp_db['id'] == i]
-            title = submission.title.values[0]
+        for i, title in submissions:
             body += ' "{}" \n'.format(title)
 
         body = email_reject.format(body)
@@ -636,13 +2456,76 @@ Bio:
         subject = subject.format(spkr)
         msgHtml = body.replace('\n', '<br>')
         msgPlain = body
-        #print('{} of {} [{}]'.format(x, y, spkr))
-        x += 1
-        #SendMessage(sender, to, subject, msgHtml, msgPlain)
-        #time.sleep(.1)
-        #print(body)
+        if with_rejected:
+            messages.append({'sender': sender, 'to': to, 'subject': subject,
+                             'html': msgHtml, 'plain': msgPlain})
+
+    if dry_run:
+        for m in messages:
+            print('To: {}\nSubject: {}\n{}'.format(
+                m['to'], m['subject'], m['plain']))
+        return
+
+    if transport == 'smtp':
+        _transport = SMTPTransport(smtp_host, smtp_port)
+    elif transport == 'file':
+        _transport = FileTransport(outbox)
+    else:
+        _transport = GmailTransport()
+
+    journal = _SendJournal(journal)
+    try:
+        print('Sending {} messages'.format(len(messages)))
+        failures = _send_all(_transport, messages, journal, rate=rate,
+                             batch_size=batch_size, workers=workers)
+    finally:
+        journal.close()
+    print('Done, {} failed (rerun to retry them)'.format(len(failures)))
+
+
+def _build_mailing(speakers_db, submissions_db, sched, cfp_db):
+    """Work out who gets which acceptance and rejection mail
+
+    sched.speakers must already be split into lists of emails. Returns
+
+      accepted: {speaker email: [(session, [speaker details, ...]), ...]}
+      rejected: {speaker email: [(submission id, title), ...]}
+
+    where session is the sched row as a dict plus the submission_difficulty
+    and submission_abstract taken from submissions_db.
+    """
+    # one record per speaker email, the last one wins
+    speakers = speakers_db.drop_duplicates('email', keep='last')
+    speakers = dict((x['email'], x) for x in speakers.to_dict('records'))
+
+    # pull difficulty and abstract in with a single keyed join
+    submissions = submissions_db.drop_duplicates('id')
+    submissions = submissions.set_index(submissions.id.astype(int))
+    submissions = submissions[['difficulty', 'abstract']].rename(
+        columns=lambda x: 'submission_' + x)
+    submissions = submissions.reindex(sched.session_id.astype(int))
+    submissions.index = sched.index
+    sessions = sched.join(submissions)
+
+    accepted = defaultdict(list)
+    for session in sessions.to_dict('records'):
+        # gather all the speaker details for all speakers in the session
+        speaker_details = [speakers[x] for x in session['speakers']
+                           if x in speakers]
+        # then, combine those speaker details with the session details
+        for spkr in session['speakers']:
+            accepted[spkr].append((session, speaker_details))
+
+    # everyone with a submission that didn't make it into the schedule
+    accepted_ids = set(sched.session_id.astype(int))
+    cfp = cfp_db.drop_duplicates('id')
+    cfp = cfp[~cfp.id.astype(int).isin(accepted_ids)].sort_values('id')
+    rejected = defaultdict(list)
+    for row in cfp[['id', 'email', 'title']].itertuples(index=False):
+        rejected[row.email].append((int(row.id), row.title))
+
+    return dict(accepted), dict(rejected)
 
-        #import ipdb; ipdb.set_trace()
 
 email_reject = '''
 
@@ -814,116 +2697,141 @@ Follow us and what other's are tweeting about the event!
 '''
 
 
+SCHEDULE_STATS = ['multi-talk', 'countries', 'orgs', 'dupes', 'speakers',
+                  'totals']
+
+
+def _schedule_stats(sched, speakers_db, stats=SCHEDULE_STATS):
+    """Summaries of the program draft, as {stat: DataFrame}
+
+    sched.speakers must already be split into lists of emails. Every
+    speaker of every session is joined against the speakers table once and
+    the rest are plain grouped aggregations of that.
+    """
+    import pandas as pd
+
+    # one row per (session, speaker)
+    talks = sched[['session_id', 'speakers']].explode('speakers')
+    talks = talks.rename(columns={'speakers': 'email'})
+
+    # one row per accepted speaker, with their talk count and details
+    people = talks.groupby('email').size().rename('talks').reset_index()
+    details = speakers_db.drop_duplicates('email')[
+        ['email', 'name', 'country', 'org']]
+    people = people.merge(details, on='email', how='left')
+
+    def _counts(column):
+        values = people[column].replace('', float('nan')).fillna('unknown')
+        counts = values.value_counts().sort_index()
+        return counts.rename_axis(column).rename('count').reset_index()
+
+    results = {}
+    for stat in stats:
+        if stat == 'multi-talk':
+            results[stat] = people.loc[people.talks > 1, ['email', 'talks']]
+        elif stat == 'countries':
+            results[stat] = _counts('country')
+        elif stat == 'orgs':
+            results[stat] = _counts('org')
+        elif stat == 'dupes':
+            counts = sched.session_id.value_counts().sort_index()
+            results[stat] = counts.rename_axis('session_id').rename(
+                'count').reset_index()
+        elif stat == 'speakers':
+            summary = people[people.email != 'shadowman']
+            results[stat] = summary.sort_values(['org', 'name'])[
+                ['name', 'org', 'country']]
+        elif stat == 'totals':
+            results[stat] = pd.DataFrame([
+                {'total': 'sessions', 'count': len(sched)},
+                {'total': 'speakers', 'count': len(people)}])
+        else:
+            raise ValueError('Invalid stat: {}'.format(stat))
+    return results
+
+
+def _print_schedule_stats(results):
+    titles = {
+        'multi-talk': 'Speakers with > 1 talk',
+        'countries': 'Speaker Countries',
+        'orgs': 'Speaker Orgs',
+        'dupes': 'ACCEPTED ids:',
+        'speakers': 'ACCEPTED SPEAKERS SUMMARY',
+    }
+    for stat, df in results.items():
+        if stat in titles:
+            print(titles[stat])
+        for row in df.itertuples(index=False):
+            if stat == 'multi-talk':
+                print(' {}: {}'.format(row.email, row.talks))
+            elif stat in ('countries', 'orgs', 'dupes'):
+                print('{: <3} x {}'.format(row.count, row[0]))
+            elif stat == 'speakers':
+                print('{: <25} @ {: <15}: {}'.format(
+                    row.name, row.org, row.country))
+            elif stat == 'totals':
+                print('Total {}: {}'.format(row.total, row.count))
+        print()
+
+
 @cli.command()
+@click.option('--stats', default=','.join(SCHEDULE_STATS),
+              help='Comma separated list of: ' + ', '.join(SCHEDULE_STATS))
+@click.option('--format', 'fmt', default='text',
+              type=click.Choice(['text', 'csv', 'json']))
 @click.pass_obj
-def schedule(obj):
+def schedule(obj, stats, fmt):
+    stats = [x.strip() for x in stats.split(',') if x.strip()]
+    for stat in stats:
+        if stat not in SCHEDULE_STATS:
+            raise click.BadParameter('unknown stat {}'.format(stat),
+                                     param_hint='--stats')
+
     db_url = '1hpmxiUJ3DwkbEUdOfEFo2CmIZVWU2w6oYz4B5MEJZDU'
     speakers_wks = 'speakers'
     submissions_wks = 'submissions'
     sched_url = '1xi3QpEhIx3R600ZvKpbEPJ5D-z5o9j5fMHMFpFb_hPw'
     sched_wks = 'All Sessions'
 
-    print('Getting Speakers DB...')
-    speakers_db = pd.read_csv(
-        '/home/cward/Downloads/DevConf.cz - MASTER db - speakers.csv')
+    # progress goes to stderr so csv / json output stays clean
+    click.echo('Getting Speakers DB...', err=True)
+    speakers_db = _load_table(
+        '/home/cward/Downloads/DevConf.cz - MASTER db - speakers.csv',
+        ['email', 'name', 'country', 'org'])
 
-    print('Getting Submissions DB...')
-    submissions_db = pd.read_csv(
-        '/home/cward/Downloads/DevConf.cz - MASTER db - submissions.csv')
+    click.echo('Getting Submissions DB...', err=True)
+    submissions_db = _load_table(
+        '/home/cward/Downloads/DevConf.cz - MASTER db - submissions.csv',
+        ['id', 'title', 'name', 'org', 'type'])
 
-    print('Getting Submissions...')
-    sched = pd.read_csv(
-        '/home/cward/Downloads/DevConf.cz 2017 - Program Draft - All Sessions.csv')
+    click.echo('Getting Submissions...', err=True)
+    sched = _load_table(
+        '/home/cward/Downloads/DevConf.cz 2017 - Program Draft - All Sessions.csv',
+        ['session_id', 'speakers'])
 
-    print('Getting all original submissions')
-    source_db = pd.read_csv(
-        '/home/cward/Downloads/Devconf.cz CfP Submissions - SOURCE - CLEAN Talks MASTER.csv')
-
-    print('Processing data...')
+    click.echo('Processing data...', err=True)
 
     # get a full list of all accepted speakers
     sched['speakers'] = sched.speakers.map(
         lambda x: [y.strip() for y in x.split(';')])
 
-    # print out the speaker session counts
-    speakers_k = Counter()
-    for _ in sched.speakers.to_dict().values():
-        for spkr in _:
-            speakers_k.update({spkr: 1})
-
-    # pull out a list of the unique speakers
-    speakers = sorted(speakers_k.keys())
-
-    print()
-
-    print('Speakers with > 1 talk')
-    for spkr, k in speakers_k.items():
-        if k > 1:
-            print(' {}: {}'.format(spkr, k))
-
-    print()
-
-    print('Speaker Countries')
-    # print out the speaker country counts
-    countries_k = Counter()
-    for spkr in speakers:
-        person = speakers_db[speakers_db.email == spkr]
-        country = person.country
-        if not country.any():
-            countries_k.update({'unknown': 1})
-        else:
-            countries_k.update({country.values[0]: 1})
-    for x, y in sorted(countries_k.items()):
-        print('{: <3} x {}'.format(y, x))
-
-    print()
-
-    print('Speaker Orgs')
-    # print out the speaker country counts
-    orgs_k = Counter()
-    for spkr in speakers:
-        person = speakers_db[speakers_db.email == spkr]
-        org = person.org
-        if not org.any():
-            orgs_k.update({'unknown': 1})
-        else:
-            orgs_k.update({org.values[0]: 1})
-    for x, y in sorted(orgs_k.items()):
-        print('{: <3} x {}'.format(y, x))
-
-    print()
+    results = _schedule_stats(sched, speakers_db, stats)
+
+    if fmt == 'json':
+        # speakers missing from speakers_db come out of the merge as NaN,
+        # which json.dumps would write as a bare (invalid) NaN
+        print(json.dumps(dict((k, v.astype(object).where(
+                                  v.notnull(), None).to_dict('records'))
+                              for k, v in results.items()),
+                         indent=2, default=str))
+    elif fmt == 'csv':
+        for stat, df in results.items():
+            print('# {}'.format(stat))
+            print(df.to_csv(index=False))
+    else:
+        _print_schedule_stats(results)
 
-    # duplicate talks?
     accepted = sorted(sched.session_id.values)
-    accepted_k = Counter()
-    for x in accepted:
-        accepted_k.update({x: 1})
-    print('ACCEPTED ids:')
-    for x, y in sorted(accepted_k.items()):
-        print('{: <3} x {}'.format(y, x))
-
-    print()
-
-    print("ACCEPTED SPEAKERS SUMMARY")
-    # accepted speaker summary
-    speakers_list = []
-    for _ in speakers:
-        if _ == 'shadowman':
-            continue
-        spkr = speakers_db[speakers_db.email == _]
-        name = spkr.name.values[0]
-        country = spkr.country.values[0]
-        org = spkr.org.values[0]
-        speakers_list.append({'name': name, 'country': country, 'org': org})
-
-    for i in sorted(speakers_list, key=lambda x: (x['org'], x['name'])):
-        print('{: <25} @ {: <15}: {}'.format(
-            i['name'], i['org'], i['country']))
-
-    print()
-
-    print('Total sessions: {}'.format(len(accepted)))
-    print('Total speakers: {}'.format(len(speakers)))
 
     def rejected():
         # rejected talks
@@ -947,18 +2855,1118 @@ def schedule(obj):
     #rejected()
 
 
-    #import ipdb; ipdb.set_trace()
+## Schedule Builder ##
+#
+# `build-schedule` lays the accepted sessions out in blocks, a block being
+# one room's uninterrupted stretch of a day (ie, D105 09:00-12:30). The
+# sessions of a block run back to back, so a timetable is just the order
+# of the sessions in every block. A greedy pass fills the blocks track by
+# track, then simulated annealing moves and swaps sessions to clear what's
+# left of the conflicts and keep tracks together. Every move is costed on
+# the blocks and speakers it touches only, which keeps 500+ sessions in 10
+# rooms to a few seconds.
+
+SCHEDULE_HARD = 1000  # per clash, unfit session or overflowing minute
+# leaving a session out for a human to place beats breaking a hard rule
+SCHEDULE_UNPLACED = 500
+SCHEDULE_WEIGHTS = {
+    'track': 10,  # track changes between neighbouring sessions of a room
+    'difficulty': 3,  # neighbours of the same difficulty
+}
+PROGRAM_DRAFT = ('/home/cward/Downloads/DevConf.cz 2017 - Program Draft - '
+                 'All Sessions.csv')
+
+
+def _session_length(_type, default=50):
+    """Talk plus Q&A minutes of a "Talk 40m+10m" style type"""
+    talk = _get_duration(str(_type))
+    if talk == 'UNKNOWN':
+        return default
+    try:
+        qa = int(str(_type).split(' ')[-1].split('+')[1].rstrip('m'))
+    except (IndexError, ValueError):
+        qa = 0
+    return talk + qa
+
+
+def _parse_clock(value):
+    hours, minutes = value.strip().split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+def _format_clock(minutes):
+    return '{:02d}:{:02d}'.format(*divmod(minutes, 60))
+
+
+def _parse_rooms(rooms):
+    """"D105,A112:Workshop|Lab" -> [(room, set of allowed types), ...]"""
+    parsed = []
+    for room in rooms.split(','):
+        name, _, types = room.strip().partition(':')
+        parsed.append((name, set(x for x in types.split('|') if x)))
+    return parsed
+
+
+def _schedule_blocks(rooms, days, hours):
+    blocks = []
+    for day in days:
+        for room, types in rooms:
+            for span in hours.split(','):
+                start, end = span.split('-')
+                blocks.append({'room': room, 'day': day, 'types': types,
+                               'start': _parse_clock(start),
+                               'end': _parse_clock(end)})
+    return blocks
+
+
+class _Timetable(object):
+    """Sessions in blocks, with the cost of every block and speaker
+
+    sessions are dicts with minutes, speakers, track, difficulty and type;
+    availability is {email: {day: [(start, end), ...]}} for the speakers
+    that only have some windows. The last "block" holds the sessions that
+    couldn't be placed.
+    """
+
+    def __init__(self, sessions, blocks, availability=None, changeover=0):
+        self.sessions = sessions
+        self.blocks = blocks
+        self.availability = availability or {}
+        self.changeover = changeover
+        self.unplaced = len(blocks)
+        self.order = [[] for _ in range(len(blocks) + 1)]
+        self.where = [self.unplaced] * len(sessions)
+        self.order[self.unplaced] = list(range(len(sessions)))
+        self.times = [None] * len(sessions)
+
+        self.by_speaker = defaultdict(list)
+        for i, session in enumerate(sessions):
+            for email in session['speakers']:
+                self.by_speaker[email].append(i)
+        self.block_costs = [self._block_cost(b)
+                            for b in range(len(self.order))]
+        self.speaker_costs = dict((x, 0) for x in self.by_speaker)
+
+    def _layout(self, b):
+        if b == self.unplaced:
+            for i in self.order[b]:
+                self.times[i] = None
+            return
+        block = self.blocks[b]
+        start = block['start']
+        for i in self.order[b]:
+            end = start + self.sessions[i]['minutes']
+            self.times[i] = (block['day'], start, end)
+            start = end + self.changeover
+
+    def _available(self, session, day, start, end):
+        for email in session['speakers']:
+            windows = self.availability.get(email)
+            if windows is None:
+                continue
+            if not any(a <= start and end <= z
+                       for a, z in windows.get(day, [])):
+                return False
+        return True
+
+    def _block_cost(self, b):
+        if b == self.unplaced:
+            return SCHEDULE_UNPLACED * len(self.order[b])
+        block = self.blocks[b]
+        cost = 0
+        previous = None
+        for i in self.order[b]:
+            session = self.sessions[i]
+            day, start, end = self.times[i]
+            if end > block['end']:
+                cost += SCHEDULE_HARD * (end - max(start, block['end']))
+            if block['types'] and session['type'] not in block['types']:
+                cost += SCHEDULE_HARD
+            if not self._available(session, day, start, end):
+                cost += SCHEDULE_HARD
+            if previous is not None:
+                if previous['track'] != session['track']:
+                    cost += SCHEDULE_WEIGHTS['track']
+                if (previous['difficulty'] == session['difficulty'] and
+                        session['difficulty'] != 'UNKNOWN'):
+                    cost += SCHEDULE_WEIGHTS['difficulty']
+            previous = session
+        return cost
+
+    def _speaker_cost(self, email):
+        sessions = self.by_speaker[email]
+        if len(sessions) < 2:
+            return 0
+        spans = sorted(self.times[i] for i in sessions if self.times[i])
+        # sorted by start, an overlap always shows up between neighbours
+        return SCHEDULE_HARD * sum(1 for a, b in zip(spans, spans[1:])
+                                   if a[0] == b[0] and b[1] < a[2])
+
+    def cost(self):
+        return sum(self.block_costs) + sum(self.speaker_costs.values())
+
+    def change(self, orders):
+        """Give blocks new orders, returns the change in cost and an undo"""
+        before = dict((b, self.order[b]) for b in orders)
+        speakers = set(email for b in orders for i in self.order[b]
+                       for email in self.sessions[i]['speakers'])
+        old_costs = dict((b, self.block_costs[b]) for b in orders)
+        old_speakers = dict((x, self.speaker_costs[x]) for x in speakers)
+
+        for b, order in orders.items():
+            self.order[b] = order
+            for i in order:
+                self.where[i] = b
+            self._layout(b)
+        delta = 0
+        for b in orders:
+            self.block_costs[b] = self._block_cost(b)
+            delta += self.block_costs[b] - old_costs[b]
+        for email in speakers:
+            self.speaker_costs[email] = self._speaker_cost(email)
+            delta += self.speaker_costs[email] - old_speakers[email]
+
+        def undo():
+            for b, order in before.items():
+                self.order[b] = order
+                for i in order:
+                    self.where[i] = b
+                self._layout(b)
+                self.block_costs[b] = old_costs[b]
+            self.speaker_costs.update(old_speakers)
+        return delta, undo
+
+    def _fits(self, i, b):
+        session = self.sessions[i]
+        block = self.blocks[b]
+        if block['types'] and session['type'] not in block['types']:
+            return False
+        start = block['start']
+        if self.order[b]:
+            start = self.times[self.order[b][-1]][2] + self.changeover
+        end = start + session['minutes']
+        if end > block['end']:
+            return False
+        if not self._available(session, block['day'], start, end):
+            return False
+        for email in session['speakers']:
+            for j in self.by_speaker[email]:
+                other = self.times[j]
+                if (other and other[0] == block['day'] and
+                        other[1] < end and start < other[2]):
+                    return False
+        return True
+
+    def _free(self, b):
+        """Minutes left at the end of block b"""
+        end = self.times[self.order[b][-1]][2] if self.order[b] else \
+            self.blocks[b]['start']
+        return self.blocks[b]['end'] - end
+
+    def greedy(self):
+        """Fill the blocks track by track, biggest track first"""
+        tracks = defaultdict(list)
+        for i, session in enumerate(self.sessions):
+            tracks[session['track']].append(i)
+        tracks = sorted(tracks.values(), reverse=True, key=lambda x: sum(
+            self.sessions[i]['minutes'] for i in x))
+
+        for members in tracks:
+            # round robin over the difficulties, so they're spread out
+            levels = defaultdict(list)
+            for i in members:
+                levels[self.sessions[i]['difficulty']].append(i)
+            queues = sorted(levels.values(), key=len, reverse=True)
+            members = [q[n] for n in range(len(queues[0])) for q in queues
+                       if n < len(q)]
+
+            last = None
+            for i in members:
+                # stay in the track's block, then the emptiest one
+                candidates = sorted(range(len(self.blocks)),
+                                    key=self._free, reverse=True)
+                if last is not None:
+                    candidates.insert(0, last)
+                for b in candidates:
+                    if self._fits(i, b):
+                        unplaced = list(self.order[self.unplaced])
+                        unplaced.remove(i)
+                        self.change({b: self.order[b] + [i],
+                                     self.unplaced: unplaced})
+                        last = b
+                        break
+
+    def _move(self, rng):
+        """A random swap or relocation, as (kind, new orders of the blocks)
+
+        Blocks are mostly full, so a swap takes a session of the same
+        length (which can't overrun anything) half of the time, and an
+        unplaced session is only moved into a block it has room in.
+        """
+        i = rng.randrange(len(self.sessions))
+        a = self.where[i]
+        if rng.random() < 0.5:
+            session = self.sessions[i]
+            pick = rng.random()
+            if pick < 0.5:
+                mates = self.by_length[session['minutes']]
+            elif pick < 0.75:
+                mates = self.by_track[session['track']]
+            else:
+                mates = range(len(self.sessions))
+            j = mates[rng.randrange(len(mates))]
+            b = self.where[j]
+            if i == j or a == b == self.unplaced:
+                return None
+            if a == b:
+                order = list(self.order[a])
+                x, y = order.index(i), order.index(j)
+                order[x], order[y] = order[y], order[x]
+                return 'swap', {a: order}
+            order_a, order_b = list(self.order[a]), list(self.order[b])
+            order_a[order_a.index(i)] = j
+            order_b[order_b.index(j)] = i
+            return 'swap', {a: order_a, b: order_b}
+
+        if a == self.unplaced:
+            minutes = self.sessions[i]['minutes'] + self.changeover
+            room = [x for x in range(len(self.blocks))
+                    if self._free(x) >= minutes]
+            if not room:
+                return None
+            b = rng.choice(room)
+        else:
+            b = rng.randrange(len(self.blocks))
+        order_a = [x for x in self.order[a] if x != i]
+        order_b = order_a if a == b else list(self.order[b])
+        order_b.insert(rng.randint(0, len(order_b)), i)
+        if a == b:
+            return 'relocate', {a: order_b}
+        return 'relocate', {a: order_a, b: order_b}
+
+    def improve(self, seconds=5, seed=1):
+        """Simulated annealing, returns what it did as a dict
+
+        That's the iterations, the moves tried / accepted / improving by
+        kind and the start and end temperatures and costs.
+        """
+        import math
+        import random
+
+        rng = random.Random(seed)
+        self.by_track = defaultdict(list)
+        self.by_length = defaultdict(list)
+        for i, session in enumerate(self.sessions):
+            self.by_track[session['track']].append(i)
+            self.by_length[session['minutes']].append(i)
+
+        cost = best = initial = self.cost()
+        best_order = [list(x) for x in self.order]
+        start = time.time()
+        temperature = start_temperature = 2.0 * SCHEDULE_WEIGHTS['track']
+        stats = dict((kind, {'tried': 0, 'accepted': 0, 'improving': 0})
+                     for kind in ('swap', 'relocate'))
+        iterations = 0
+        while self.sessions:
+            if iterations % 200 == 0:
+                elapsed = time.time() - start
+                if elapsed >= seconds:
+                    break
+                temperature = start_temperature * (1 - elapsed / seconds)
+            iterations += 1
+
+            move = self._move(rng)
+            if move is None:
+                continue
+            kind, orders = move
+            stats[kind]['tried'] += 1
+            delta, undo = self.change(orders)
+            if delta <= 0 or rng.random() < math.exp(
+                    -delta / max(temperature, 0.01)):
+                stats[kind]['accepted'] += 1
+                stats[kind]['improving'] += delta < 0
+                cost += delta
+                if cost < best:
+                    best = cost
+                    best_order = [list(x) for x in self.order]
+            else:
+                undo()
+
+        self.change(dict(enumerate(best_order)))
+        return dict(stats, iterations=iterations, initial=initial,
+                    best=best, temperature=(start_temperature,
+                                            max(temperature, 0.0)))
+
+    def problems(self):
+        """Counts of what's wrong with the timetable"""
+        counts = {'unplaced': len(self.order[self.unplaced]),
+                  'speaker clashes': sum(self.speaker_costs.values()) //
+                  SCHEDULE_HARD,
+                  'overruns': 0, 'wrong room': 0, 'unavailable': 0,
+                  'track changes': 0}
+        for b, block in enumerate(self.blocks):
+            previous = None
+            for i in self.order[b]:
+                session = self.sessions[i]
+                day, start, end = self.times[i]
+                counts['overruns'] += end > block['end']
+                counts['wrong room'] += bool(
+                    block['types'] and session['type'] not in block['types'])
+                counts['unavailable'] += not self._available(
+                    session, day, start, end)
+                counts['track changes'] += bool(
+                    previous and previous['track'] != session['track'])
+                previous = session
+        return counts
+
+
+def _load_availability(path):
+    """{email: {day: [(start, end), ...]}} from an email,day,start,end csv"""
+    availability = defaultdict(lambda: defaultdict(list))
+    for row in _load_table(path).to_dict('records'):
+        availability[row['email'].strip()][str(row['day']).strip()].append(
+            (_parse_clock(row['start']), _parse_clock(row['end'])))
+    return availability
+
+
+@cli.command('build-schedule')
+@click.option('--sessions', 'sessions_path', default=PROGRAM_DRAFT,
+              help='Accepted sessions csv (the program draft)')
+@click.option('--submissions', default=None,
+              help='Submissions csv to take the difficulty from, by id')
+@click.option('--rooms', required=True,
+              help='Comma separated, a room may be limited to some types, '
+                   'ie: D105,D0206,A112:Workshop|Lab')
+@click.option('--days', required=True,
+              help='Comma separated, ie: 2018-01-26,2018-01-27')
+@click.option('--hours', default='09:00-12:30,13:30-18:00',
+              help='Daily blocks of every room')
+@click.option('--availability', default=None,
+              help='csv of email,day,start,end windows; speakers not in it '
+                   'are available all the time')
+@click.option('--changeover', default=5, help='Minutes between sessions')
+@click.option('--default-length', default=50,
+              help='Minutes for types without a duration, ie meetups')
+@click.option('--time-limit', default=5.0, help='Seconds of local search')
+@click.option('--seed', default=1)
+@click.option('--out', default='program-schedule.csv', help='Output csv')
+@click.pass_obj
+def build_schedule(obj, sessions_path, submissions, rooms, days, hours,
+                   availability, changeover, default_length, time_limit,
+                   seed, out):
+    """Timetable the accepted sessions into rooms and days"""
+    start = time.time()
+    sched = _load_table(sessions_path)
+    sched = sched.reset_index(drop=True)
+
+    if 'difficulty' not in sched.columns and submissions:
+        levels = _load_table(submissions, ['id', 'difficulty'])
+        levels = levels.drop_duplicates('id').set_index(
+            levels.id.astype(int)).difficulty
+        sched['difficulty'] = levels.reindex(
+            sched.session_id.astype(int)).values
+
+    def column(name, default='UNKNOWN'):
+        if name not in sched.columns:
+            return [default] * len(sched)
+        return sched[name].fillna(default).astype(str).tolist()
+
+    if 'session_duration' in sched.columns:
+        # the program draft keeps them as "duration:40" and "qa:10"
+        minutes = [int(str(a).split(':')[-1]) + int(str(b).split(':')[-1])
+                   for a, b in zip(sched.session_duration,
+                                   sched.session_qa.fillna('qa:0'))]
+    else:
+        minutes = [_session_length(x, default_length)
+                   for x in column('type')]
+
+    sessions = []
+    for i, (speakers, track, level, _type) in enumerate(zip(
+            column('speakers', ''), column('track'),
+            column('difficulty'), column('type'))):
+        sessions.append({
+            'minutes': minutes[i],
+            'speakers': [x.strip() for x in speakers.split(';')
+                         if x.strip()],
+            'track': track,
+            'difficulty': level,
+            'type': _get_type(_type),
+        })
+
+    days = [x.strip() for x in days.split(',') if x.strip()]
+    blocks = _schedule_blocks(_parse_rooms(rooms), days, hours)
+    timetable = _Timetable(
+        sessions, blocks, changeover=changeover,
+        availability=_load_availability(availability) if availability
+        else None)
+    timetable.greedy()
+    click.echo('Greedy: cost {}, {}'.format(
+        timetable.cost(), timetable.problems()), err=True)
+    search = timetable.improve(seconds=time_limit, seed=seed)
+    problems = timetable.problems()
+    click.echo('Search: cost {} (greedy {}, {:+d}) after {} moves, {}'.format(
+        search['best'], search['initial'], search['best'] - search['initial'],
+        search['iterations'], problems), err=True)
+    click.echo('  temperature {:.1f} -> {:.1f}; {}'.format(
+        search['temperature'][0], search['temperature'][1], ', '.join(
+            '{}s {accepted}/{tried} accepted, {improving} improving'.format(
+                kind, **search[kind]) for kind in ('swap', 'relocate'))),
+        err=True)
+
+    placed = dict((i, b) for b in range(len(blocks))
+                  for i in timetable.order[b])
+    def placement(value):
+        return [value(i) if i in placed else None
+                for i in range(len(sessions))]
+
+    sched['day'] = placement(lambda i: blocks[placed[i]]['day'])
+    sched['room'] = placement(lambda i: blocks[placed[i]]['room'])
+    sched['start'] = placement(lambda i: _format_clock(timetable.times[i][1]))
+    sched['end'] = placement(lambda i: _format_clock(timetable.times[i][2]))
+    sched = sched.sort_values(['day', 'start', 'room'], na_position='last')
+    sched.to_csv(out, index=False)
+
+    click.echo('Scheduled {} of {} sessions into {} in {:.1f}s'.format(
+        len(placed), len(sessions), out, time.time() - start), err=True)
+    if problems['unplaced'] or problems['speaker clashes']:
+        raise click.ClickException(
+            '{unplaced} sessions unplaced, {speaker clashes} speaker '
+            'clashes'.format(**problems))
+
+
+## Static Site ##
+#
+# `render-site` renders docs/speakers.html and docs/schedule.html (and the
+# copies in the year folders) from the cleaned csvs through the templates
+# in bin/templates. Each page depends on its templates and on the slice of
+# the data it shows; the csvs are only read when one of them changed on
+# disk, and a page is only re-rendered when its slice did, so a room swap
+# doesn't touch the speakers page. Images processed by site-images are
+# rendered as its <picture> elements.
+
+BIN_PATH = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_PATH = os.path.join(BIN_PATH, 'templates')
+SITE_PATHS = [os.path.join(BIN_PATH, os.pardir, 'docs'),
+              os.path.join(BIN_PATH, os.pardir, 'docs', '2017')]
+RENDER_MANIFEST = os.path.join(BASE_PATH, 'cache', 'render-site.json')
+
+# templates each page is built from
+SITE_PAGES = {
+    'speakers.html': ['page.html', 'speaker.html'],
+    'schedule.html': ['page.html', 'day.html', 'session.html'],
+}
+
+
+@functools.lru_cache()
+def _page_template(name):
+    """bin/templates/name, parsed once per run"""
+    import string
+
+    class _Template(string.Template):
+        # only ${name}, the pages are full of jquery's $(...)
+        pattern = r'''
+        \$(?:
+          (?P<escaped>(?!))|
+          (?P<named>(?!))|
+          {(?P<braced>[_a-z][_a-z0-9]*)}|
+          (?P<invalid>(?!))
+        )'''
+
+    path = os.path.join(TEMPLATE_PATH, name)
+    with open(path, encoding='utf-8') as f:
+        return _Template(f.read())
+
+
+def _file_digest(path, known=None):
+    """sha1 of the file, reusing known {path: [mtime, size, sha1]} if the
+    file wasn't touched since"""
+    import hashlib
+
+    st = os.stat(path)
+    stamp = [st.st_mtime_ns, st.st_size]
+    if known and known.get(path, [None])[:2] == stamp:
+        return known[path]
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    return stamp + [sha.hexdigest()]
+
+
+def _read_rows(path):
+    import csv
+
+    # plain csv, pandas would cost more than the whole render
+    with open(os.path.expanduser(path), encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def _site_data(speakers_path, submissions_path, schedule_path=None):
+    """The slices of the data each page shows, as plain json-able dicts"""
+    speakers = {}
+    for row in _read_rows(speakers_path):
+        speakers[row['email'].strip()] = row  # the last one wins
+
+    submissions = dict((str(x['id']).strip(), x)
+                       for x in _read_rows(submissions_path) if x.get('id'))
+
+    sessions = []
+    if schedule_path and os.path.exists(os.path.expanduser(schedule_path)):
+        for row in _read_rows(schedule_path):
+            _id = str(row['session_id']).strip()
+            submission = submissions.get(_id, {})
+            emails = [x.strip() for x in row.get('speakers', '').split(';')
+                      if x.strip()]
+            sessions.append(dict(submission, **{
+                'id': _id, 'emails': emails,
+                'title': row.get('title') or submission.get('title', ''),
+                'type': row.get('type') or submission.get('type', ''),
+                'track': row.get('track', ''),
+                'day': row.get('day', ''), 'room': row.get('room', ''),
+                'start': row.get('start', ''), 'end': row.get('end', '')}))
+    else:
+        # nothing scheduled yet, list what was accepted
+        for _id, submission in submissions.items():
+            sessions.append(dict(submission, id=_id, track='', day='',
+                                 room='', start='', end='', emails=[
+                                     x.strip() for x in submission.get(
+                                         'email', '').split(';')
+                                     if x.strip()]))
+
+    names = dict((k, v.get('name', k)) for k, v in speakers.items())
+    talks = defaultdict(list)
+    for session in sessions:
+        for email in session['emails']:
+            talks[email].append({'id': session['id'],
+                                 'title': session['title']})
+
+    page_speakers = []
+    for email in sorted(talks, key=lambda x: names.get(x, x).lower()):
+        if email not in speakers:
+            continue
+        speaker = dict((k, speakers[email].get(k) or '') for k in
+                       ['name', 'org', 'country', 'twitter', 'avatar', 'bio'])
+        speaker.update(email=email, sessions=talks[email])
+        page_speakers.append(speaker)
+
+    fields = ['id', 'title', 'type', 'track', 'difficulty', 'abstract',
+              'day', 'room', 'start', 'end']
+    page_sessions = []
+    for session in sessions:
+        row = dict((k, session.get(k) or '') for k in fields)
+        row['speakers'] = [(x, names.get(x, x)) for x in session['emails']]
+        page_sessions.append(row)
+    page_sessions.sort(key=lambda x: (not x['day'], x['day'], x['start'],
+                                      x['room'], x['title']))
+
+    return {'speakers.html': page_speakers, 'schedule.html': page_sessions}
+
+
+def _speaker_anchor(email):
+    return 'speaker-' + re.sub(r'[^a-z0-9]+', '-', email.lower()).strip('-')
+
+
+def _nav(active):
+    items = []
+    for page, label in [('schedule.html', 'Schedule'),
+                        ('speakers.html', 'Speakers')]:
+        if page == active:
+            items.append('<li class="active"><a>{}</a></li>'.format(label))
+        else:
+            items.append('<li><a href="{}">{}</a></li>'.format(page, label))
+    return '\n            '.join(items)
+
+
+def _render_speakers(speakers):
+    from html import escape
+
+    cards = []
+    for speaker in speakers:
+        handle = _clean_twitter(speaker['twitter'])
+        twitter = ''
+        if handle:
+            twitter = ('<p><a href="https://twitter.com/{0}" class="fa '
+                       'fa-twitter"> @{0}</a></p>'.format(escape(handle)))
+        sessions = '\n'.join(
+            '            <li><a href="schedule.html#session-{}">{}</a></li>'
+            .format(escape(x['id']), escape(x['title']))
+            for x in speaker['sessions'])
+        cards.append(_page_template('speaker.html').substitute(
+            anchor=_speaker_anchor(speaker['email']),
+            avatar=escape(speaker['avatar']), name=escape(speaker['name']),
+            org=escape(speaker['org']),
+            country=escape(', ' + speaker['country']
+                           if speaker['country'] else ''),
+            twitter=twitter, bio=escape(speaker['bio']), sessions=sessions))
+
+    rows = []
+    for i in range(0, len(cards), 3):
+        rows.append('        <div class="row">\n{}        </div>'.format(
+            ''.join(cards[i:i + 3])))
+    return _page_template('page.html').substitute(
+        nav=_nav('speakers.html'), heading='Speakers',
+        content='\n'.join(rows))
+
+
+def _render_schedule(sessions):
+    from html import escape
+    from itertools import groupby
+
+    days = []
+    for day, group in groupby(sessions, key=lambda x: x['day']):
+        rows = []
+        for session in group:
+            speakers = ', '.join(
+                '<a href="speakers.html#{}">{}</a>'.format(
+                    _speaker_anchor(email), escape(name))
+                for email, name in session['speakers'])
+            time_ = '{} - {}'.format(session['start'], session['end']) \
+                if session['start'] else ''
+            rows.append(_page_template('session.html').substitute(
+                time=time_, speakers=speakers,
+                **dict((k, escape(session[k])) for k in
+                       ['id', 'room', 'title', 'type', 'track',
+                        'difficulty', 'abstract'])))
+        label = day or 'To be announced'
+        days.append(_page_template('day.html').substitute(
+            anchor='day-' + (day or 'tba'), day=escape(label),
+            sessions=''.join(rows)))
+    return _page_template('page.html').substitute(
+        nav=_nav('schedule.html'), heading='Schedule',
+        content='\n'.join(days))
+
+
+def _write_atomic(path, text):
+    with open(path + '.part', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.rename(path + '.part', path)
+
+
+def _render_site(inputs, out_dirs, force=False):
+    """Re-render the pages whose inputs changed, returns the paths written
+
+    The manifest keeps, per output page, the digests of its files
+    (templates, csvs and the site-images manifest), of the data slice it
+    shows and of every copy of the output itself, so a hand edit of a
+    generated page gets undone too.
+    """
+    import hashlib
+
+    try:
+        manifest = json.load(open(RENDER_MANIFEST))
+    except Exception:
+        manifest = {}
+    known = manifest.get('files', {})
+    pages = manifest.get('pages', {})
+
+    try:
+        images = json.load(open(SITE_IMAGE_MANIFEST))
+    except Exception:
+        images = {}
+    depends = [os.path.join(TEMPLATE_PATH, x) for x in
+               set(sum(SITE_PAGES.values(), []))]
+    if os.path.exists(SITE_IMAGE_MANIFEST):
+        depends.append(SITE_IMAGE_MANIFEST)
+
+    digests = {}
+    for path in inputs + depends:
+        digests[path] = _file_digest(path, known)
+
+    data = None
+    written = []
+    for page, templates in sorted(SITE_PAGES.items()):
+        depends = [os.path.join(TEMPLATE_PATH, t) for t in templates]
+        if SITE_IMAGE_MANIFEST in digests:
+            depends.append(SITE_IMAGE_MANIFEST)
+        files = dict((x, digests[x][2]) for x in inputs + depends)
+        targets = [os.path.abspath(os.path.join(x, page)) for x in out_dirs]
+
+        entry = pages.get(page)
+        # the copies differ, image urls are relative to each of them
+        untouched = entry and 'outputs' in entry and all(
+            os.path.exists(x) and
+            _file_digest(x, known)[2] == entry['outputs'].get(x)
+            for x in targets)
+        if not force and untouched and entry['files'] == files:
+            continue
+
+        if data is None:
+            data = _site_data(*inputs)
+        slice_digest = hashlib.sha1(json.dumps(
+            [data[page]] + [files[x] for x in depends],
+            sort_keys=True).encode('utf-8')).hexdigest()
+
+        if not force and untouched and entry['data'] == slice_digest:
+            # the csvs changed, but not in a way this page shows
+            entry['files'] = files
+            continue
+
+        render = _render_speakers if page == 'speakers.html' else \
+            _render_schedule
+        html = render(data[page])
+        outputs = {}
+        for target in targets:
+            out = html
+            if images.get('sizes'):
+                out = _responsive_images(html, os.path.dirname(target),
+                                         images['done'], images['sizes'])
+            _write_atomic(target, out)
+            written.append(target)
+            outputs[target] = hashlib.sha1(out.encode('utf-8')).hexdigest()
+        pages[page] = {'files': files, 'data': slice_digest,
+                       'outputs': outputs}
+
+    # remember the stats of everything we hashed, outputs included
+    for page in SITE_PAGES:
+        for out_dir in out_dirs:
+            target = os.path.abspath(os.path.join(out_dir, page))
+            if os.path.exists(target):
+                digests[target] = _file_digest(target, known if target
+                                               not in written else None)
+    manifest = {'files': digests, 'pages': pages}
+    if not os.path.exists(os.path.dirname(RENDER_MANIFEST)):
+        os.makedirs(os.path.dirname(RENDER_MANIFEST))
+    _write_atomic(RENDER_MANIFEST, json.dumps(manifest, indent=2,
+                                              sort_keys=True))
+    return written
+
+
+@cli.command('render-site')
+@click.option('--speakers', 'speakers_path',
+              default='/home/cward/Downloads/speakers.csv',
+              help='Cleaned speakers csv (see cleanup)')
+@click.option('--submissions', 'submissions_path',
+              default='/home/cward/Downloads/submissions.csv',
+              help='Cleaned submissions csv (see cleanup)')
+@click.option('--schedule', 'schedule_path', default='program-schedule.csv',
+              help='Timetable csv (see build-schedule)')
+@click.option('--out', 'out_dirs', multiple=True,
+              help='Site directory, repeatable (default: docs, docs/2017)')
+@click.option('--force', default=False, is_flag=True,
+              help='Render everything, changed or not')
+@click.pass_obj
+def render_site(obj, speakers_path, submissions_path, schedule_path,
+                out_dirs, force):
+    """Render the speakers and schedule pages from the cleaned data"""
+    start = time.time()
+    inputs = [os.path.abspath(os.path.expanduser(x)) for x in
+              [speakers_path, submissions_path, schedule_path]]
+    if not os.path.exists(inputs[2]):
+        inputs = inputs[:2]  # nothing scheduled yet
+    written = _render_site(inputs, list(out_dirs) or SITE_PATHS,
+                           force=force)
+    for path in written:
+        print('Rendered {}'.format(os.path.relpath(path)))
+    print('{} pages rendered in {:.2f}s'.format(len(written),
+                                                time.time() - start))
+
+
+## Responsive Images ##
+#
+# `site-images` builds smaller widths and webp (optionally avif) encodings
+# of the png / jpg files under the img folders of the site with the engine
+# in process-images.py, and rewrites the <img> tags pointing at them into
+# <picture> elements with srcsets. Variants are encoded once per source
+# content into SITE_IMAGE_CACHE and hard linked into <img>/responsive, so
+# reruns only encode what changed. render-site reads the manifest and
+# renders the same <picture> markup, so neither undoes the other.
+
+SITE_ROOT = os.path.join(BIN_PATH, os.pardir, 'docs')
+SITE_IMAGE_CACHE = os.path.join(BASE_PATH, 'cache', 'site-images')
+SITE_IMAGE_MANIFEST = os.path.join(SITE_IMAGE_CACHE, 'manifest.json')
+RESPONSIVE_DIR = 'responsive'
+RESPONSIVE_WIDTHS = (480, 960, 1440)
+# preferred first, browsers take the first <source> they can show
+RESPONSIVE_FORMATS = ('avif', 'webp')
+RASTER_FORMATS = {'.png': 'png', '.jpg': 'jpeg', '.jpeg': 'jpeg'}
+IMG_TAG = re.compile(r'<img\b[^>]*>', re.I)
+RESPONSIVE_PICTURE = re.compile(
+    r'<picture data-responsive>.*?(<img\b[^>]*>)</picture>', re.I | re.S)
+
+
+def _site_images(site):
+    """[(path, img folder)] of the raster images under site"""
+    images = []
+    for root, dirs, files in os.walk(site):
+        dirs[:] = sorted(x for x in dirs if x != RESPONSIVE_DIR)
+        parts = os.path.relpath(root, site).split(os.sep)
+        if 'img' not in parts:
+            continue
+        img_dir = os.path.join(site, *parts[:len(parts) - parts[::-1].index(
+            'img')])
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in RASTER_FORMATS:
+                images.append((os.path.join(root, name), img_dir))
+    return images
+
+
+def _responsive_variants(path, img_dir, width, key, widths, formats):
+    """[(width, fmt, out path, cache path)] of one image
+
+    The widths below its own in its own format (its own width is the
+    original file) and all of them plus its own in the modern formats.
+    """
+    own = RASTER_FORMATS[os.path.splitext(path)[1].lower()]
+    stem = os.path.splitext(os.path.relpath(path, img_dir))[0]
+    smaller = [x for x in widths if x < width]
+    variants = []
+    for fmt in [own] + formats:
+        for w in smaller + ([width] if fmt != own else []):
+            ext = 'jpg' if fmt == 'jpeg' else fmt
+            variants.append((w, fmt, os.path.join(
+                img_dir, RESPONSIVE_DIR, '{}-{}w.{}'.format(stem, w, ext)),
+                os.path.join(SITE_IMAGE_CACHE, '{}-{}w.{}'.format(
+                    key, w, ext))))
+    return variants
+
+
+def _link_variant(cache_path, out_path):
+    if os.path.exists(out_path) and os.path.samefile(cache_path, out_path):
+        return False  # unchanged
+    if os.path.lexists(out_path):
+        os.remove(out_path)
+    elif not os.path.exists(os.path.dirname(out_path)):
+        os.makedirs(os.path.dirname(out_path))
+    try:
+        os.link(cache_path, out_path)
+    except OSError:
+        shutil.copyfile(cache_path, out_path)  # ie, different filesystem
+    return True
+
+
+def _prune_variants(img_dirs, expected):
+    """Remove what's left in the responsive folders from older runs"""
+    removed = []
+    for img_dir in img_dirs:
+        out_dir = os.path.join(img_dir, RESPONSIVE_DIR)
+        if not os.path.isdir(out_dir):
+            continue
+        for root, _, files in os.walk(out_dir, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in expected:
+                    os.remove(path)
+                    removed.append(path)
+            if not os.listdir(root):
+                os.rmdir(root)
+    return removed
+
+
+@METRICS.timed('site.images')
+def _build_site_images(site, widths, formats, workers=4, sizes=None):
+    """Encode the missing variants and link all of them into place
+
+    Only variants lighter than the original are used. The manifest keeps
+    them along with sizes, the pages' sizes attribute (None if the pages
+    are left alone), for render-site to render the same markup. Returns
+    {path: (width, fmt, [(width, fmt, out path)])} for every image of
+    site, the failures as {'file': ..., 'error': ...} dicts and the number
+    of variants encoded and removed.
+    """
+    import hashlib
+    from concurrent.futures import ThreadPoolExecutor
+    from PIL import Image
+
+    engine = _image_engine()
+    params = hashlib.sha1(json.dumps(
+        engine.RESPONSIVE_PARAMS, sort_keys=True).encode('utf-8')).hexdigest()
+
+    try:
+        manifest = json.load(open(SITE_IMAGE_MANIFEST))
+    except Exception:
+        manifest = {}
+    known = manifest.get('files', {})
+    known_widths = manifest.get('widths', {})
+    if not os.path.exists(SITE_IMAGE_CACHE):
+        os.makedirs(SITE_IMAGE_CACHE)
+
+    digests = {}
+    source_widths = {}
+    plan = {}
+    jobs = {}
+    failures = []
+    images = _site_images(site)
+    for path, img_dir in images:
+        try:
+            digests[path] = _file_digest(path, known)
+            digest = digests[path][2]
+            if digest not in known_widths:
+                known_widths[digest] = Image.open(path).width
+        except Exception as e:
+            failures.append({'file': path, 'error': '{}: {}'.format(
+                type(e).__name__, e)})
+            continue
+        source_widths[digest] = known_widths[digest]
+        # the same picture in two places is encoded once
+        key = hashlib.sha1((digest + params).encode('utf-8')).hexdigest()
+        plan[path] = _responsive_variants(path, img_dir, known_widths[digest],
+                                          key, widths, formats)
+        missing = [(w, fmt, cache) for w, fmt, _, cache in plan[path]
+                   if not os.path.exists(cache)]
+        if missing:
+            jobs.setdefault(key, (path, missing))
+
+    encoded = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(engine.convert_responsive, path, missing)
+                   for path, missing in jobs.values()]
+        for future in futures:
+            path, outputs, error = future.result()
+            encoded += len(outputs)
+            if error:
+                failures.append({'file': path, 'error': error})
+    METRICS.incr('images_encoded', encoded)
+
+    done = {}
+    expected = set()
+    for path, variants in plan.items():
+        if not all(os.path.exists(x[3]) for x in variants):
+            continue  # failed, left as is
+        # a variant heavier than the original (ie a palette png gone
+        # truecolor) is worse than no variant at all
+        size = os.path.getsize(path)
+        variants = [x for x in variants if os.path.getsize(x[3]) < size]
+        for _, _, out_path, cache_path in variants:
+            _link_variant(cache_path, out_path)
+            expected.add(out_path)
+        own = RASTER_FORMATS[os.path.splitext(path)[1].lower()]
+        done[path] = (known_widths[digests[path][2]], own,
+                      [x[:3] for x in variants])
+    removed = _prune_variants(set(x[1] for x in images), expected)
+
+    manifest = {'files': digests, 'widths': source_widths,
+                'done': done if sizes else {}, 'sizes': sizes}
+    _write_atomic(SITE_IMAGE_MANIFEST, json.dumps(manifest, indent=2,
+                                                  sort_keys=True))
+    return done, failures, encoded, len(removed)
+
+
+def _site_url(path, html_dir):
+    return os.path.relpath(path, html_dir).replace(os.sep, '/')
+
+
+def _srcset(entries, html_dir):
+    return ', '.join('{} {}w'.format(_site_url(path, html_dir), width)
+                     for width, path in entries)
+
+
+def _unwrap_pictures(html):
+    """Undo an earlier rewrite, back to the plain <img> tags"""
+    return RESPONSIVE_PICTURE.sub(
+        lambda m: re.sub(r'\s(?:srcset|sizes)="[^"]*"', '', m.group(1)),
+        html)
+
+
+def _responsive_images(html, html_dir, done, sizes='100vw'):
+    """Wrap the <img> tags pointing at a processed image in <picture>
+    elements, html_dir is the folder of the page
+
+    An image is shown no wider than it is (ie, the footer icons), only the
+    ones marked data-full-width get sizes as their sizes attribute.
+    """
+    def _wrap(match):
+        img = match.group(0)
+        src = re.search(r'\ssrc="([^"]+)"', img)
+        if not src or re.match(r'[a-z]+:|//', src.group(1)):
+            return img  # external or data: url
+        path = os.path.normpath(os.path.join(html_dir, src.group(1)))
+        if path not in done:
+            return img
+        width, own, variants = done[path]
+        _sizes = sizes if re.search(r'\sdata-full-width\b', img) else \
+            '(max-width: {0}px) 100vw, {0}px'.format(width)
+
+        sources = ''
+        for fmt in RESPONSIVE_FORMATS:
+            entries = [(w, x) for w, _fmt, x in variants if _fmt == fmt]
+            if entries:
+                sources += '<source type="image/{}" srcset="{}" ' \
+                           'sizes="{}">'.format(fmt, _srcset(entries,
+                                                             html_dir), _sizes)
+        fallback = [(w, x) for w, _fmt, x in variants if _fmt == own]
+        if not sources and not fallback:
+            return img
+        attrs = ' srcset="{}" sizes="{}"'.format(
+            _srcset(fallback + [(width, path)], html_dir), _sizes)
+        img = re.sub(r'\s*(/?)>$', lambda m: attrs + (
+            ' />' if m.group(1) else '>'), img)
+        return '<picture data-responsive>{}{}</picture>'.format(sources, img)
+
+    return IMG_TAG.sub(_wrap, _unwrap_pictures(html))
+
+
+def _rewrite_images(html_path, done, sizes='100vw'):
+    """_responsive_images() of one page, returns whether the page changed"""
+    html_dir = os.path.dirname(os.path.abspath(html_path))
+    with open(html_path, encoding='utf-8') as f:
+        original = f.read()
+
+    html = _responsive_images(original, html_dir, done, sizes)
+    if html == original:
+        return False
+    _write_atomic(html_path, html)
+    return True
+
+
+@cli.command('site-images')
+@click.option('--site', default=SITE_ROOT, help='Site directory')
+@click.option('--widths', default=','.join(map(str, RESPONSIVE_WIDTHS)),
+              help='Comma separated widths to offer (px)')
+@click.option('--formats', default='webp',
+              help='Comma separated modern formats: webp, avif')
+@click.option('--sizes', default='100vw',
+              help='sizes attribute of the images marked data-full-width, '
+                   'the others are shown up to their own width')
+@click.option('--workers', default=os.cpu_count(),
+              help='Images encoded in parallel')
+@click.option('--no-rewrite', default=False, is_flag=True,
+              help='Only build the variants, leave the pages alone')
+@click.pass_obj
+def site_images(obj, site, widths, formats, sizes, workers, no_rewrite):
+    """Build resized / webp variants of the site images and use them"""
+    from PIL import features
+
+    start = time.time()
+    site = os.path.abspath(os.path.expanduser(site))
+    widths = sorted(int(x) for x in widths.split(','))
+    formats = [x.strip().lower() for x in formats.split(',') if x.strip()]
+    for fmt in list(formats):
+        if fmt not in RESPONSIVE_FORMATS:
+            raise click.BadParameter('unknown format {}'.format(fmt),
+                                     param_hint='--formats')
+        if not features.check(fmt):
+            print('WARNING: this Pillow can\'t write {}, skipped'.format(fmt))
+            formats.remove(fmt)
+
+    done, failures, encoded, removed = _build_site_images(
+        site, widths, formats, workers=workers,
+        sizes=None if no_rewrite else sizes)
+    print('{} images, {} variants encoded, {} removed'.format(
+        len(done), encoded, removed))
+    for failure in failures:
+        print('FAILED: {file} ({error})'.format(**failure))
+
+    if not no_rewrite:
+        for root, dirs, files in os.walk(site):
+            for name in sorted(files):
+                if name.endswith('.html') and _rewrite_images(
+                        os.path.join(root, name), done, sizes):
+                    print('Rewrote {}'.format(os.path.relpath(
+                        os.path.join(root, name))))
+    print('Done in {:.2f}s'.format(time.time() - start))
 
 
 @cli.command()
 @click.pass_obj
 def cleanup(obj):
-    speakers_db = pd.read_csv(
+    import numpy as np
+
+    speakers_db = _load_table(
         '/home/cward/Downloads/DevConf.cz - MASTER db - speakers_clean.csv')
-    submissions_db = pd.read_csv(
+    submissions_db = _load_table(
         '/home/cward/Downloads/DevConf.cz - MASTER db - submissions_clean.csv')
-    sched = pd.read_csv('/home/cward/Downloads/DevConf.cz 2017 - Program Draft - All Sessions.csv')
-    cfp_db = pd.read_csv('/home/cward/Downloads/Devconf.cz CfP Submissions - SOURCE - CLEAN Talks MASTER.csv')
+    sched = _load_table('/home/cward/Downloads/DevConf.cz 2017 - Program Draft - All Sessions.csv',
+                        ['session_id', 'speakers'])
 
     split_speakers = lambda x: [y.strip() for y in x.split(';')]
     # make the list of speakers a list of speakers
@@ -982,5 +3990,235 @@ def cleanup(obj):
 
 
 
+## Live Ingestion ##
+#
+# `watch` takes typeform webhook POSTs on a local http endpoint and falls
+# back to polling with the store watermark. New proposals are queued and
+# flushed in micro-batches, by a single worker thread, into the local store
+# and (optionally) appended to the sheet.
+
+def _webhook_value(answer):
+    """The answer of a webhook form_response as the v1 api strings"""
+    kind = answer.get('type')
+    if kind == 'choice':
+        return [answer['choice'].get('label') or answer['choice'].get(
+            'other', '')]
+    if kind == 'choices':
+        choices = answer['choices']
+        return choices.get('labels', []) + (
+            [choices['other']] if choices.get('other') else [])
+    if kind == 'file_url':
+        return [answer['file_url']]
+    value = answer.get(kind, '')
+    if isinstance(value, bool):
+        value = '1' if value else '0'
+    return [str(value)]
+
+
+def _parse_webhook(payload):
+    """Turn a webhook payload into a proposal, same as _parse_response
+
+    There's no network_id in webhook payloads, so the `_id` is the response
+    token; _store_proposals matches it to the polled copy of the response
+    (or the other way around) so neither the store nor the sheet end up
+    with it twice.
+    """
+    form_response = payload['form_response']
+    titles = dict((x['id'], ' '.join(x['title'].split()))
+                  for x in form_response['definition']['fields'])
+
+    submitted = datetime.datetime.strptime(
+        form_response['submitted_at'][:19], '%Y-%m-%dT%H:%M:%S')
+    response = {
+        'token': form_response['token'],
+        'metadata': {
+            'date_submit': submitted.strftime(DT_FORMAT),
+        },
+        'answers': {},
+    }
+    questions = {}
+    aliases = dict((' '.join(k.split()), k) for k in QUESTION_ALIAS)
+    for answer in form_response.get('answers', []):
+        question = aliases.get(titles.get(answer['field']['id'], ''))
+        if not question:
+            continue  # not a question we care about
+        # multiple choices become one v1 style answer each (ie, themes)
+        for i, value in enumerate(_webhook_value(answer)):
+            key = '{}_{}'.format(answer['field']['id'], i)
+            questions[key] = question
+            response['answers'][key] = value or ''
+    proposal = _parse_response(response, questions)
+    proposal['event'] = _form_event(form_response.get('form_id'))
+    return proposal
+
+
+def _check_signature(secret, body, signature):
+    import base64
+    import hashlib
+    import hmac
+
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    expected = 'sha256=' + base64.b64encode(digest).decode()
+    return hmac.compare_digest(expected, signature or '')
+
+
+def _webhook_server(host, port, inbox, secret=None, worker=None):
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class _Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if secret and not _check_signature(
+                    secret, body, self.headers.get('Typeform-Signature')):
+                self.send_response(401)
+                self.end_headers()
+                return
+            try:
+                proposal = _parse_webhook(json.loads(body.decode('utf-8')))
+            except Exception as e:
+                print('ERROR: bad webhook payload ({})'.format(e))
+                self.send_response(400)
+                self.end_headers()
+                return
+            if worker is not None and not worker.is_alive():
+                # nothing would store it, have typeform deliver it again
+                self.send_response(503)
+                self.end_headers()
+                return
+            inbox.put(proposal)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Server((host, port), _Handler)
+
+
+def _watch_loop(obj, inbox, stop, poll=300, flush=5, batch_size=50,
+                sheet_path=None, wks_name='Submissions MASTER'):
+    """Single writer: micro-batches webhook proposals, polls, uploads"""
+    import queue
+
+    conn = _open_store()
+    wks = None
+    sheet = '{}/{}'.format(sheet_path, wks_name)
+    next_poll = time.time() if poll else None
+
+    batch = []  # webhook proposals not stored yet
+    try:
+        # keep going after stop until everything queued is stored
+        while not stop.is_set() or not inbox.empty() or batch:
+            deadline = time.time() + flush
+            while len(batch) < batch_size and time.time() < deadline:
+                try:
+                    batch.append(inbox.get(timeout=max(
+                        0.1, deadline - time.time())))
+                except queue.Empty:
+                    pass
+
+            changed = 0
+            if batch:
+                try:
+                    with conn:
+                        stored = _store_proposals(conn, batch)
+                        if stored:
+                            _bump_version(conn)
+                    changed += stored
+                    print('Stored {} proposals from webhooks'.format(
+                        len(batch)))
+                    batch = []
+                except Exception as e:
+                    print('ERROR: storing {} proposals failed ({})'.format(
+                        len(batch), e))
+                    if stop.is_set():
+                        print('ERROR: {} proposals not stored'.format(
+                            len(batch) + inbox.qsize()))
+                        break
+                    # they're tried again with the next batch
+                    stop.wait(flush)
+
+            if next_poll and time.time() >= next_poll:
+                try:
+                    polled = _sync_store(conn, obj.forms())
+                    if polled:
+                        print('Stored {} proposals from polling'.format(
+                            polled))
+                    changed += polled
+                except Exception as e:
+                    print('ERROR: polling failed ({})'.format(e))
+                next_poll = time.time() + poll
+
+            if changed and sheet_path:
+                try:
+                    if wks is None:
+                        wks = _open_worksheet(sheet_path, wks_name,
+                                              write_access=True)
+                    proposals = _sheet_columns(
+                        _load_frame(conn, events=obj.events))
+                    new, col_names = _diff_submissions(
+                        conn, sheet, wks, proposals)
+                    updated = _changed_submissions(conn, sheet, proposals)
+                    if updated:
+                        cells = _update_submissions(conn, sheet, wks,
+                                                    proposals, updated)
+                        print('Updated {} cells in {} proposals'.format(
+                            cells, len(updated)))
+                    if not new.empty:
+                        _append_submissions(conn, sheet, wks, new,
+                                            col_names=col_names)
+                        print('Uploaded {} proposals'.format(len(new)))
+                except Exception as e:
+                    # they stay pending and go out with the next batch
+                    print('ERROR: upload failed ({})'.format(e))
+    finally:
+        conn.close()
+
+
+@cli.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8000)
+@click.option('--secret', default=None,
+              help='Typeform webhook secret, to check the signatures')
+@click.option('--poll', default=300,
+              help='Seconds between polls for missed responses, 0 is off')
+@click.option('--flush', default=5, help='Seconds to batch up webhooks')
+@click.option('--batch-size', default=50)
+@click.option('--upload', default=False, is_flag=True,
+              help='Append new proposals to the gspreadsheet')
+@click.option('--path', default='devconfcz_proposals',
+              help='gspreadsheet to upload to')
+@click.pass_obj
+def watch(obj, host, port, secret, poll, flush, batch_size, upload, path):
+    """Ingest new submissions live, from webhooks and polling"""
+    import queue
+    import threading
+
+    inbox = queue.Queue()
+    stop = threading.Event()
+    worker = threading.Thread(
+        target=_watch_loop, args=(obj, inbox, stop),
+        kwargs={'poll': poll, 'flush': flush, 'batch_size': batch_size,
+                'sheet_path': path if upload else None})
+    worker.start()
+
+    server = _webhook_server(host, port, inbox, secret=secret,
+                             worker=worker)
+    print('Listening for webhooks on http://{}:{}/'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # let the worker flush whatever is still queued
+        stop.set()
+        worker.join()
+
+
 if __name__ == '__main__':
     cli(obj={})
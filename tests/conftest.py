@@ -0,0 +1,48 @@
+import importlib.util
+import json
+import os
+import threading
+
+import pytest
+
+BIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'bin')
+
+
+def _load(name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(BIN_PATH, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def benchmark():
+    return _load('benchmark')
+
+
+@pytest.fixture
+def tf(benchmark, tmp_path):
+    """typeform.py with its ~/.config/typeform under tmp_path"""
+    module = benchmark._typeform(str(tmp_path))
+    os.makedirs(module.BASE_PATH)
+    with open(module.CONFIG_FILE, 'w') as f:
+        json.dump({'url': 'http://127.0.0.1/v1/form/TEST'}, f)
+    return module
+
+
+@pytest.fixture
+def serve():
+    """Run an http server in the background, returns its base url"""
+    servers = []
+
+    def _serve(server):
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return 'http://{}:{}'.format(*server.server_address)
+
+    yield _serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,176 @@
+import json
+import random
+import urllib.error
+import urllib.request
+
+
+def _form(benchmark, tf, count):
+    rng = random.Random(1)
+    return benchmark._form(tf, rng, count, benchmark._speakers(rng, 10))
+
+
+def test_iter_proposals_pages_through_every_response(benchmark, tf, serve):
+    form = _form(benchmark, tf, 250)
+    url = serve(benchmark._mock_server(form)) + '/v1/form/TEST'
+
+    proposals = list(tf._iter_proposals(url, {}, page_size=40,
+                                        concurrency=3))
+
+    assert len(proposals) == 250
+    assert len(set(x['_id'] for x in proposals)) == 250
+    assert [x['token'] for x in proposals] == \
+        [x['token'] for x in form['responses']]
+
+
+def test_iter_proposals_stops_on_a_short_page(benchmark, tf, serve):
+    form = _form(benchmark, tf, 80)
+    # no `showing`, the client has to notice the last page itself
+    form['stats'] = {'responses': {}}
+    server = benchmark._mock_server(form)
+    url = serve(server) + '/v1/form/TEST'
+
+    assert len(list(tf._iter_proposals(url, {}, page_size=40))) == 80
+    assert len(list(tf._iter_proposals(url, {}, page_size=100))) == 80
+
+
+def test_iter_proposals_since(benchmark, tf, serve):
+    form = _form(benchmark, tf, 100)
+    url = serve(benchmark._mock_server(form)) + '/v1/form/TEST'
+    since = benchmark.calendar.timegm(benchmark.time.strptime(
+        form['responses'][59]['metadata']['date_submit'],
+        '%Y-%m-%d %H:%M:%S'))
+
+    proposals = list(tf._iter_proposals(url, {'since': since},
+                                        page_size=15))
+
+    assert [x['token'] for x in proposals] == \
+        [x['token'] for x in form['responses'][60:]]
+
+
+def _post(url, body, signature=None):
+    request = urllib.request.Request(url, data=body)
+    if signature:
+        request.add_header('Typeform-Signature', signature)
+    try:
+        return urllib.request.urlopen(request).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_webhook_checks_the_signature(tf, serve):
+    import base64
+    import hashlib
+    import hmac
+    import queue
+
+    inbox = queue.Queue()
+    url = serve(tf._webhook_server('127.0.0.1', 0, inbox, secret='s3cret'))
+    body = json.dumps({'form_response': {
+        'form_id': 'TEST', 'token': 'abc',
+        'submitted_at': '2017-10-01T12:00:00Z',
+        'definition': {'fields': []}, 'answers': []}}).encode('utf-8')
+    signature = 'sha256=' + base64.b64encode(hmac.new(
+        b's3cret', body, hashlib.sha256).digest()).decode()
+
+    assert _post(url, body) == 401
+    assert _post(url, body, 'sha256=' + signature[7:][::-1]) == 401
+    assert inbox.empty()
+    assert _post(url, body, signature) == 200
+    assert inbox.get_nowait()['token'] == 'abc'
+
+
+def _messages(count):
+    return [{'sender': 'cfp@devconf.cz',
+             'to': 'speaker{}@example.com'.format(i), 'subject': 'DevConf.cz',
+             'html': '<p>Hi</p>', 'plain': 'Hi'} for i in range(count)]
+
+
+def test_send_all_resumes_from_the_journal(tf, tmp_path):
+    outbox = tmp_path / 'outbox'
+    path = str(tmp_path / 'sent.jsonl')
+
+    class _Flaky(tf.FileTransport):
+        # every other message fails, like a crash halfway through
+        def send_batch(self, messages):
+            results = super(_Flaky, self).send_batch(messages)
+            return [(None, 'boom') if i % 2 else x
+                    for i, x in enumerate(results)]
+
+    journal = tf._SendJournal(path)
+    failures = tf._send_all(_Flaky(str(outbox)), _messages(6), journal,
+                            rate=1000, batch_size=4)
+    journal.close()
+    assert len(failures) == 3
+    assert len(open(path).readlines()) == 3
+
+    for eml in outbox.iterdir():
+        eml.unlink()
+    journal = tf._SendJournal(path)
+    failures = tf._send_all(tf.FileTransport(str(outbox)), _messages(6),
+                            journal, rate=1000, batch_size=4)
+    journal.close()
+    # only what failed goes out again
+    assert failures == []
+    assert len(list(outbox.iterdir())) == 3
+    assert len(open(path).readlines()) == 6
+
+
+def test_sync_only_bumps_the_version_on_changes(benchmark, tf, serve):
+    form = _form(benchmark, tf, 30)
+    url = serve(benchmark._mock_server(form)) + '/v1/form/TEST'
+    conn = tf._open_store()
+
+    assert tf._sync_store(conn, {'test': (url, {})}) == 30
+    version = tf._get_meta(conn, 'version')
+    # everything again, as an inclusive `since` would
+    assert tf._sync_store(conn, {'test': (url, {})}, full=True) == 0
+    assert tf._get_meta(conn, 'version') == version
+
+
+def test_find_duplicates_leaves_out_empty_text(tf):
+    import pandas as pd
+
+    abstract = 'tracing the linux kernel with ebpf from user space tools'
+    proposals = pd.DataFrame({
+        'title': ['eBPF tracing', 'eBPF tracing', 'UNKNOWN', 'UNKNOWN', ''],
+        'abstract': [abstract, abstract + ' today', 'UNKNOWN', None, ''],
+    }, index=['a', 'b', 'c', 'd', 'e'])
+
+    clusters, skipped = tf._find_duplicates(proposals)
+
+    assert [[x[:2] for x in cluster] for cluster in clusters] == \
+        [[('a', 'b')]]
+    assert sorted(skipped) == ['c', 'd', 'e']
+
+
+def test_feather_index_only_for_frames_we_wrote(tf, tmp_path):
+    import pandas as pd
+
+    proposals = pd.DataFrame({'title': ['a', 'b']},
+                             index=pd.Index(['x', 'y'], name='_id'))
+    path = str(tmp_path / 'proposals.feather')
+    tf._write_table(proposals, path, 'feather')
+    assert tf._load_table(path).equals(proposals)
+
+    # a csv that happens to have an _id column keeps it as a column,
+    # served from the feather cache or not
+    csv = tmp_path / 'sessions.csv'
+    csv.write_text('_id,title\nx,a\ny,b\n')
+    first = tf._load_table(str(csv))
+    assert list(first.columns) == ['_id', 'title']
+    assert tf._load_table(str(csv)).equals(first)
+
+
+def test_responsive_images_keep_their_own_width(tf, tmp_path):
+    site = str(tmp_path)
+    logo = tf.os.path.join(site, 'img', 'logo.png')
+    small = tf.os.path.join(site, 'img', 'responsive', 'logo-160w.webp')
+    done = {logo: (310, 'png', [(160, 'webp', small), (310, 'webp', small)])}
+    html = ('<img src="img/logo.png" alt="logo">'
+            '<img data-full-width src="img/logo.png">')
+
+    html = tf._responsive_images(html, site, done, sizes='100vw')
+
+    assert html.count('sizes="(max-width: 310px) 100vw, 310px"') == 2
+    assert html.count('sizes="100vw"') == 2
+    assert tf._responsive_images(html, site, done, sizes='100vw') == html